@@ -0,0 +1,54 @@
+# albums.py
+"""
+Media albums arrive as one update per item, sharing a ``media_group_id``.
+``AlbumBuffer`` holds the items of an album until no new one came for
+``window`` seconds (or the album is full), then passes them to ``on_album``
+together, ordered by message_id, so the album is checked and relayed once
+(``send_media_group``) instead of item by item.
+"""
+import asyncio
+from typing import Any, Callable, Dict, List, Tuple
+
+MAX_ALBUM_ITEMS = 10  # Bot API limit for sendMediaGroup
+
+AlbumHandler = Callable[[List[Any]], Any]
+
+
+class AlbumBuffer:
+    def __init__(self, on_album: AlbumHandler, window: float = 1.0):
+        self.on_album = on_album
+        self.window = window
+        # (sender, media_group_id) -> (items, flush timer)
+        self._albums: Dict[Tuple[int, str], Tuple[List[Any], asyncio.TimerHandle]] = {}
+
+    def __len__(self):
+        return len(self._albums)
+
+    def add(self, uid: int, message: Any):
+        """Buffer ``message`` (an item of ``message.media_group_id``) sent by ``uid``."""
+        key = (uid, message.media_group_id)
+        items, timer = self._albums.pop(key, ([], None))
+        if timer is not None:
+            timer.cancel()
+        items.append(message)
+        if len(items) >= MAX_ALBUM_ITEMS:
+            self._flush(items)
+            return
+        timer = asyncio.get_running_loop().call_later(self.window, self._expire, key)
+        self._albums[key] = (items, timer)
+
+    def _expire(self, key: Tuple[int, str]):
+        items, _ = self._albums.pop(key, ([], None))
+        return self._flush(items) if items else None
+
+    def _flush(self, items: List[Any]):
+        items.sort(key=lambda m: m.message_id)
+        return self.on_album(items)
+
+    def flush_all(self) -> List[Any]:
+        """Hand over everything still buffered (shutdown); returns what ``on_album`` returned."""
+        results = []
+        for key in list(self._albums):
+            self._albums[key][1].cancel()
+            results.append(self._expire(key))
+        return results
@@ -0,0 +1,107 @@
+# antispam.py
+"""
+Per-user anti-spam state: "same text again within SPAM_INTERVAL" and
+"messages too often" (token bucket: SEND_BURST messages, refilled one per
+SEND_INTERVAL).
+
+Entries hold no message text (only its hash) and expire from a heap once
+neither rule can fire any more, so memory follows the users active in the
+last SPAM_INTERVAL instead of everyone who ever wrote.
+"""
+import heapq
+import sys
+import time
+from typing import Dict, List, Optional, Tuple
+
+DUPLICATE = "duplicate"
+TOO_FAST = "too_fast"
+
+
+class _Entry:
+    __slots__ = ("text_hash", "text_at", "send_at", "tokens")
+
+    def __init__(self, tokens: float):
+        self.text_hash = 0
+        self.text_at = float("-inf")
+        self.send_at = float("-inf")
+        self.tokens = tokens
+
+
+class SpamGuard:
+    def __init__(self, spam_interval: float, send_interval: float, burst: int = 1):
+        self.spam_interval = spam_interval
+        self.send_interval = send_interval
+        self.burst = max(1, burst)
+        self.rate = 1.0 / send_interval if send_interval > 0 else float("inf")
+        self._entries: Dict[int, _Entry] = {}
+        self._expiry: List[Tuple[float, int]] = []
+
+    def _tokens(self, entry: _Entry, now: float) -> float:
+        if self.rate == float("inf"):
+            return float(self.burst)
+        return min(float(self.burst), entry.tokens + (now - entry.send_at) * self.rate)
+
+    def _expires_at(self, entry: _Entry) -> float:
+        # after this the entry is equivalent to a fresh one
+        refill = (self.burst - entry.tokens) / self.rate if self.rate != float("inf") else 0.0
+        return max(entry.text_at + self.spam_interval, entry.send_at + refill)
+
+    def _expire(self, now: float):
+        heap = self._expiry
+        while heap and heap[0][0] <= now:
+            _, uid = heapq.heappop(heap)
+            entry = self._entries.get(uid)
+            if entry is not None and self._expires_at(entry) <= now:
+                del self._entries[uid]
+
+    def check(self, uid: int, text: Optional[str], now: Optional[float] = None) -> Optional[str]:
+        """None if the message may go out; DUPLICATE or TOO_FAST otherwise. Does not record anything."""
+        now = time.monotonic() if now is None else now
+        self._expire(now)
+        entry = self._entries.get(uid)
+        if entry is None:
+            return None
+        if text is not None and entry.text_hash == hash(text) and now - entry.text_at < self.spam_interval:
+            return DUPLICATE
+        if self._tokens(entry, now) < 1.0:
+            return TOO_FAST
+        return None
+
+    def record(self, uid: int, text: Optional[str], now: Optional[float] = None):
+        """Account one sent message; ``text`` None for media (resets duplicate tracking)."""
+        now = time.monotonic() if now is None else now
+        entry = self._entries.get(uid)
+        if entry is None:
+            entry = self._entries[uid] = _Entry(float(self.burst))
+        entry.tokens = self._tokens(entry, now) - 1.0
+        entry.send_at = now
+        if text is None:  # "hi", photo, "hi" is not a repeat
+            entry.text_hash = 0
+            entry.text_at = float("-inf")
+        else:
+            entry.text_hash = hash(text)
+            entry.text_at = now
+        heapq.heappush(self._expiry, (self._expires_at(entry), uid))
+
+    def retry_in(self, uid: int, now: Optional[float] = None) -> float:
+        """Seconds until the next message is allowed by the rate rule."""
+        now = time.monotonic() if now is None else now
+        entry = self._entries.get(uid)
+        if entry is None or self.rate == float("inf"):
+            return 0.0
+        return max(0.0, (1.0 - self._tokens(entry, now)) / self.rate)
+
+    def clear(self):
+        self._entries.clear()
+        self._expiry.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def memory_bytes(self) -> int:
+        """Approximate footprint: dict + entries + expiry heap."""
+        n = len(self._entries)
+        entry_size = sys.getsizeof(_Entry(0.0)) + 3 * sys.getsizeof(0.0) + sys.getsizeof(2 ** 62)
+        heap_item = sys.getsizeof((0.0, 0)) + sys.getsizeof(0.0)
+        return (sys.getsizeof(self._entries) + n * (entry_size + sys.getsizeof(2 ** 40))
+                + sys.getsizeof(self._expiry) + len(self._expiry) * heap_item)
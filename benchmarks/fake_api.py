@@ -0,0 +1,193 @@
+# benchmarks/fake_api.py
+"""
+Fake Telegram Bot API server for offline load tests.
+
+Answers the methods the bot uses (sendMessage, sendPhoto, ..., setWebhook,
+getUpdates for polling mode: feed it with ``push_updates``) with plausible
+results, and can simulate what matters for throughput:
+  * per-call latency (+ jitter)
+  * 429 flood control: random injection and/or a real global rate limit
+  * 403 "bot was blocked by the user" for a share of chats
+
+Standalone:  python benchmarks/fake_api.py --port 8081 --latency 0.05 --blocked 0.1
+then run the bot with TELEGRAM_API_URL=http://127.0.0.1:8081
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+from collections import Counter, deque
+from typing import Any, Dict, Iterable, Optional
+
+from aiohttp import web
+
+SEND_METHODS = {"sendmessage", "sendphoto", "sendvideo", "senddocument", "sendsticker", "sendanimation",
+                "sendvoice", "sendaudio", "sendmediagroup", "copymessage", "forwardmessage"}
+
+
+class FakeBotAPI:
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, flood_prob: float = 0.0,
+                 retry_after: int = 1, blocked_ratio: float = 0.0, max_rate: Optional[float] = None):
+        self.latency = latency
+        self.jitter = jitter
+        self.flood_prob = flood_prob
+        self.retry_after = retry_after
+        self.blocked_ratio = blocked_ratio
+        self.max_rate = max_rate
+        self.calls: Counter = Counter()
+        self.results: Counter = Counter()
+        self.delivered: Dict[int, int] = {}
+        self.first_send: Optional[float] = None
+        self.last_send: Optional[float] = None
+        self._message_id = 0
+        self._tokens = max_rate or 0.0
+        self._tokens_at = time.monotonic()
+        self.updates: deque = deque()  # served by getUpdates until confirmed through its offset
+        self._updates_event: Optional[asyncio.Event] = None
+
+    # ----- behaviour -----
+    def is_blocked(self, chat_id: int) -> bool:
+        if self.blocked_ratio <= 0:
+            return False
+        return (chat_id * 2654435761 % 2 ** 32) / 2 ** 32 < self.blocked_ratio
+
+    def _rate_limited(self) -> bool:
+        if not self.max_rate:
+            return False
+        now = time.monotonic()
+        self._tokens = min(self.max_rate, self._tokens + (now - self._tokens_at) * self.max_rate)
+        self._tokens_at = now
+        if self._tokens < 1:
+            return True
+        self._tokens -= 1
+        return False
+
+    def reset(self):
+        self.calls.clear()
+        self.results.clear()
+        self.delivered.clear()
+        self.first_send = self.last_send = None
+
+    @property
+    def sent(self) -> int:
+        return self.results["ok"]
+
+    def push_updates(self, updates: Iterable[Dict[str, Any]]):
+        self.updates.extend(updates)
+        if self._updates_event is not None:
+            self._updates_event.set()
+
+    async def _get_updates(self, params: Dict[str, Any]):
+        offset = int(params.get("offset") or 0)
+        limit = min(100, int(params.get("limit") or 100))
+        timeout = float(params.get("timeout") or 0)
+        while self.updates and self.updates[0]["update_id"] < offset:
+            self.updates.popleft()  # confirmed
+        if not self.updates and timeout > 0:
+            if self._updates_event is None:
+                self._updates_event = asyncio.Event()
+            self._updates_event.clear()
+            try:
+                await asyncio.wait_for(self._updates_event.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return [u for _, u in zip(range(limit), self.updates)]
+
+    # ----- HTTP -----
+    @staticmethod
+    def _error(code: int, description: str, **params) -> web.Response:
+        body: Dict[str, Any] = {"ok": False, "error_code": code, "description": description}
+        if params:
+            body["parameters"] = params
+        return web.json_response(body, status=code)
+
+    async def _params(self, request: web.Request) -> Dict[str, Any]:
+        if request.content_type == "application/json":
+            return await request.json()
+        if request.can_read_body:
+            return dict(await request.post())
+        return dict(request.query)
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        m = method.lower()
+        self.calls[method] += 1
+        params = await self._params(request)
+        if self.latency or self.jitter:
+            await asyncio.sleep(self.latency + random.random() * self.jitter)
+
+        if m in SEND_METHODS:
+            chat_id = int(params.get("chat_id", 0))
+            if self._rate_limited() or (self.flood_prob and random.random() < self.flood_prob):
+                self.results["flood"] += 1
+                return self._error(429, f"Too Many Requests: retry after {self.retry_after}",
+                                   retry_after=self.retry_after)
+            if self.is_blocked(chat_id):
+                self.results["forbidden"] += 1
+                return self._error(403, "Forbidden: bot was blocked by the user")
+            now = time.monotonic()
+            self.first_send = self.first_send or now
+            self.last_send = now
+            self.results["ok"] += 1
+            self.delivered[chat_id] = self.delivered.get(chat_id, 0) + 1
+            return web.json_response({"ok": True, "result": self._message(m, chat_id, params)})
+        if m in ("setwebhook", "deletewebhook"):
+            return web.json_response({"ok": True, "result": True, "description": "Webhook was set"})
+        if m == "getupdates":
+            return web.json_response({"ok": True, "result": await self._get_updates(params)})
+        if m == "getme":
+            return web.json_response({"ok": True, "result": {"id": 1, "is_bot": True, "first_name": "fake",
+                                                             "username": "fake_bot"}})
+        return self._error(404, "Not Found: method not found")
+
+    def _message(self, m: str, chat_id: int, params: Dict[str, Any]):
+        def one(extra=None):
+            self._message_id += 1
+            msg = {"message_id": self._message_id, "date": int(time.time()),
+                   "chat": {"id": chat_id, "type": "private"}}
+            if m == "sendmessage":
+                msg["text"] = params.get("text", "")
+            elif params.get("caption"):
+                msg["caption"] = params["caption"]
+            if extra:
+                msg.update(extra)
+            return msg
+        if m == "sendmediagroup":
+            media = params.get("media", "[]")
+            media = json.loads(media) if isinstance(media, str) else media
+            return [one() for _ in media]
+        return one()
+
+    def app(self) -> web.Application:
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.add_routes([web.post("/bot{token}/{method}", self.handle),
+                        web.get("/bot{token}/{method}", self.handle)])
+        return app
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> web.AppRunner:
+        runner = web.AppRunner(self.app(), access_log=None)
+        await runner.setup()
+        site = web.TCPSite(runner, host, port)
+        await site.start()
+        self.url = "http://%s:%d" % runner.addresses[0][:2]
+        return runner
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8081)
+    ap.add_argument("--latency", type=float, default=0.0, help="seconds per call")
+    ap.add_argument("--jitter", type=float, default=0.0, help="extra random latency, seconds")
+    ap.add_argument("--flood", type=float, default=0.0, help="probability of a 429 per send")
+    ap.add_argument("--retry-after", type=int, default=1)
+    ap.add_argument("--blocked", type=float, default=0.0, help="share of chats that blocked the bot")
+    ap.add_argument("--max-rate", type=float, default=None, help="global sends/s before 429")
+    args = ap.parse_args()
+    api = FakeBotAPI(args.latency, args.jitter, args.flood, args.retry_after, args.blocked, args.max_rate)
+    web.run_app(api.app(), host=args.host, port=args.port, access_log=None)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,227 @@
+# benchmarks/fake_firestore.py
+"""
+In-memory stand-in for the parts of a Firestore collection the bot uses
+(document get/set/update, stream, batch). Optional per-call latency emulates
+the Firestore round trip, so cache and executor effects stay visible.
+
+``async_collections()`` exposes the same documents through AsyncClient-style
+objects (awaitable calls, ``get_all``) for ``AsyncFirestoreStorage``.
+"""
+import asyncio
+import time
+from typing import Any, Dict, Optional
+
+
+class NotFound(Exception):
+    """Same name as google.api_core.exceptions.NotFound (FirestoreStorage checks the name)."""
+
+
+class FakeSnapshot:
+    def __init__(self, doc_id: str, data: Optional[Dict[str, Any]]):
+        self.id = doc_id
+        self._data = data
+        self.exists = data is not None
+
+    def to_dict(self):
+        return dict(self._data) if self._data is not None else None
+
+
+class FakeDocument:
+    def __init__(self, col: "FakeCollection", doc_id: str):
+        self._col = col
+        self.id = doc_id
+
+    def get(self):
+        self._col._rpc("get")
+        return FakeSnapshot(self.id, self._col.docs.get(self.id))
+
+    def set(self, data: Dict[str, Any], merge: bool = False):
+        self._col._rpc("set")
+        self._col._write(self.id, data, merge)
+
+    def update(self, updates: Dict[str, Any]):
+        self._col._rpc("update")
+        if self.id not in self._col.docs:
+            raise NotFound(f"No document to update: {self.id}")
+        self._col.docs[self.id].update(updates)
+
+
+class FakeBatch:
+    def __init__(self, client: "FakeClient"):
+        self._client = client
+        self._ops = []
+
+    def set(self, ref: FakeDocument, data: Dict[str, Any], merge: bool = False):
+        self._ops.append((ref, data, merge))
+
+    def commit(self):
+        if len(self._ops) > 500:
+            raise ValueError("maximum 500 writes allowed per request")
+        if self._ops:
+            self._ops[0][0]._col._rpc("commit")
+        for ref, data, merge in self._ops:
+            ref._col._write(ref.id, data, merge)
+        self._ops = []
+
+
+class FakeClient:
+    def batch(self):
+        return FakeBatch(self)
+
+    def collection(self, name: str):
+        return FakeCollection(client=self, name=name)
+
+
+class FakeCollection:
+    def __init__(self, docs: Optional[Dict[str, Dict[str, Any]]] = None, latency: float = 0.0,
+                 client: Optional[FakeClient] = None, name: str = "anon_bot_users"):
+        self.docs: Dict[str, Dict[str, Any]] = docs if docs is not None else {}
+        self.latency = latency
+        self.id = name
+        self._client = client or FakeClient()
+        self.rpcs: Dict[str, int] = {}
+
+    def _rpc(self, op: str):
+        self.rpcs[op] = self.rpcs.get(op, 0) + 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _write(self, doc_id: str, data: Dict[str, Any], merge: bool):
+        if merge and doc_id in self.docs:
+            self.docs[doc_id].update(data)
+        else:
+            self.docs[doc_id] = dict(data)
+
+    def document(self, doc_id: str) -> FakeDocument:
+        return FakeDocument(self, doc_id)
+
+    def stream(self):
+        self._rpc("stream")
+        for doc_id, data in list(self.docs.items()):
+            yield FakeSnapshot(doc_id, data)
+
+    def where(self, field: str, op: str, value: Any) -> "FakeQuery":
+        assert op == "==", "only equality filters are faked"
+        return FakeQuery(self, field, value)
+
+
+class FakeQuery:
+    def __init__(self, collection: FakeCollection, field: str, value: Any, limit: Optional[int] = None):
+        self.collection = collection
+        self.field = field
+        self.value = value
+        self._limit = limit
+
+    def limit(self, n: int) -> "FakeQuery":
+        return FakeQuery(self.collection, self.field, self.value, n)
+
+    def stream(self):
+        self.collection._rpc("query")
+        found = 0
+        for doc_id, data in list(self.collection.docs.items()):
+            if data.get(self.field) == self.value:
+                yield FakeSnapshot(doc_id, data)
+                found += 1
+                if self._limit is not None and found >= self._limit:
+                    return
+
+
+def populate(n_users: int, start_uid: int = 1_000_000, latency: float = 0.0) -> FakeCollection:
+    docs = {str(start_uid + i): {"anon_id": f"ID{start_uid + i:010d}", "created_at": 0.0, "banned": False,
+                                 "last_send": 0.0, "last_message": ""} for i in range(n_users)}
+    return FakeCollection(docs, latency=latency)
+
+
+# ---------------------------------------------------------------- asyncio client
+class FakeAsyncDocument:
+    def __init__(self, col: "FakeAsyncCollection", doc_id: str):
+        self._col = col
+        self.id = doc_id
+
+    async def get(self):
+        await self._col._rpc("get")
+        return FakeSnapshot(self.id, self._col.docs.get(self.id))
+
+    async def set(self, data: Dict[str, Any], merge: bool = False):
+        await self._col._rpc("set")
+        self._col._sync._write(self.id, data, merge)
+
+    async def update(self, updates: Dict[str, Any]):
+        await self._col._rpc("update")
+        if self.id not in self._col.docs:
+            raise NotFound(f"No document to update: {self.id}")
+        self._col.docs[self.id].update(updates)
+
+
+class FakeAsyncBatch(FakeBatch):
+    async def commit(self):
+        if len(self._ops) > 500:
+            raise ValueError("maximum 500 writes allowed per request")
+        if self._ops:
+            await self._ops[0][0]._col._rpc("commit")
+        for ref, data, merge in self._ops:
+            ref._col._sync._write(ref.id, data, merge)
+        self._ops = []
+
+
+class FakeAsyncClient:
+    def __init__(self, col: "FakeAsyncCollection"):
+        self._col = col
+
+    def batch(self):
+        return FakeAsyncBatch(self)
+
+    async def get_all(self, refs):
+        await self._col._rpc("get_all")
+        for ref in refs:
+            yield FakeSnapshot(ref.id, self._col.docs.get(ref.id))
+
+    def close(self):
+        pass
+
+
+class FakeAsyncCollection:
+    """Async view of a FakeCollection (shared documents and RPC counters)."""
+
+    def __init__(self, sync: FakeCollection):
+        self._sync = sync
+        self.docs = sync.docs
+        self.id = sync.id
+        self._client = FakeAsyncClient(self)
+
+    async def _rpc(self, op: str):
+        self._sync.rpcs[op] = self._sync.rpcs.get(op, 0) + 1
+        if self._sync.latency:
+            await asyncio.sleep(self._sync.latency)
+
+    def document(self, doc_id: str) -> FakeAsyncDocument:
+        return FakeAsyncDocument(self, doc_id)
+
+    async def stream(self):
+        await self._rpc("stream")
+        for doc_id, data in list(self.docs.items()):
+            yield FakeSnapshot(doc_id, data)
+
+    def where(self, field: str, op: str, value: Any) -> "FakeAsyncQuery":
+        assert op == "==", "only equality filters are faked"
+        return FakeAsyncQuery(self, field, value)
+
+
+class FakeAsyncQuery(FakeQuery):
+    def limit(self, n: int) -> "FakeAsyncQuery":
+        return FakeAsyncQuery(self.collection, self.field, self.value, n)
+
+    async def stream(self):
+        await self.collection._rpc("query")
+        found = 0
+        for doc_id, data in list(self.collection.docs.items()):
+            if data.get(self.field) == self.value:
+                yield FakeSnapshot(doc_id, data)
+                found += 1
+                if self._limit is not None and found >= self._limit:
+                    return
+
+
+def async_collections(col: FakeCollection, channels: int = 1):
+    """``channels`` async clients over the same fake collection."""
+    return [FakeAsyncCollection(col) for _ in range(max(1, channels))]
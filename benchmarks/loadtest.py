@@ -0,0 +1,221 @@
+# benchmarks/loadtest.py
+"""
+Offline load test: the real bot app (create_app()) against a fake Bot API
+server and an in-memory Firestore collection.
+
+For every user count it replays synthetic webhook updates (text messages from
+distinct senders) and reports:
+  * ingest: updates/s and p50/p99 webhook ack latency
+  * fan-out: messages delivered to the fake API, msgs/s, time to drain
+
+By default Telegram's rate limits are lifted (--send-rate / --chat-rate) so the
+numbers show the bot's own overhead; pass --send-rate 30 to see real-world
+delivery time, or --api-max-rate to let the fake server answer 429s.
+
+  python benchmarks/loadtest.py --users 100 1000 10000 --updates 20
+  python benchmarks/loadtest.py --users 100000 --updates 2 --api-latency 0.03
+  python benchmarks/loadtest.py --scenario concurrent-senders
+
+Named scenarios (--scenario) fix the settings for a known question:
+  concurrent-senders  20 broadcasts from 20 senders to the same 200 users,
+                      global/per-chat limits at Telegram's 30:1 ratio (x10);
+                      throughput should stay near --send-rate (300 msg/s)
+"""
+import argparse
+import asyncio
+import json
+import os
+import itertools
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+sys.path.insert(0, HERE)
+
+from aiohttp import ClientSession, web  # noqa: E402
+
+from fake_api import FakeBotAPI  # noqa: E402
+from fake_firestore import async_collections, populate  # noqa: E402
+
+START_UID = 1_000_000
+
+SCENARIOS = {
+    "concurrent-senders": dict(users=[200], updates=20, send_rate=300.0, chat_rate=10.0, concurrency=20),
+}
+_update_ids = itertools.count(900_000)  # unique across scenarios (the bot dedupes update_id)
+
+
+def configure_env(args, api_url: str, workdir: str):
+    os.environ.setdefault("BOT_TOKEN", "123456:loadtest")
+    os.environ["TELEGRAM_API_URL"] = api_url
+    os.environ.pop("FIREBASE_CREDENTIALS_JSON", None)
+    os.environ.pop("FIREBASE_CREDENTIALS_BASE64", None)
+    os.environ.pop("WEBHOOK_URL", None)
+    os.environ.pop("WEBHOOK_SECRET_TOKEN", None)
+    os.environ["SQLITE_PATH"] = os.path.join(workdir, "users.db")
+    os.environ["USERS_FILE"] = os.path.join(workdir, "users.json")
+    os.environ["BANNED_FILE"] = os.path.join(workdir, "banned_users.txt")
+    os.environ["OUTBOX_PATH"] = os.path.join(workdir, "outbox.db")
+    os.environ["GLOBAL_SEND_RATE"] = str(args.send_rate)
+    os.environ["PER_CHAT_SEND_RATE"] = str(args.chat_rate)
+    os.environ["FANOUT_CONCURRENCY"] = str(args.concurrency)
+    os.environ["STARTUP_ANNOUNCE"] = "false"
+
+
+def make_update(update_id: int, sender: int, n: int) -> bytes:
+    return json.dumps({
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": sender, "type": "private", "first_name": "u"},
+            "from": {"id": sender, "is_bot": False, "first_name": "u"},
+            "text": f"load test message #{n} from {sender}",
+        },
+    }).encode("utf-8")
+
+
+def reset_bot_state(bot_module, n_users: int, args):
+    from cache import RecipientIndex
+    from storage import AsyncFirestoreStorage, FirestoreStorage
+
+    col = populate(n_users, START_UID, args.fs_latency)
+    if args.fs_async:
+        bot_module.storage = AsyncFirestoreStorage(async_collections(col, args.fs_channels),
+                                                   max_concurrency=args.fs_concurrency)
+    else:
+        bot_module.storage = FirestoreStorage(col, executor=bot_module._executor)
+    bot_module.recipient_index = RecipientIndex()
+    bot_module.user_cache.clear()
+    bot_module.spam_guard.clear()
+    bot_module.anon_index.clear()
+    bot_module.relay_index.clear()
+
+
+def pct(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+async def run_scenario(bot_module, api: FakeBotAPI, n_users: int, args) -> dict:
+    reset_bot_state(bot_module, n_users, args)
+    api.reset()
+
+    runner = web.AppRunner(bot_module.create_app(), access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    host, port = runner.addresses[0][:2]
+    url = f"http://{host}:{port}{bot_module.WEBHOOK_PATH}"
+
+    n_updates = args.updates
+    senders = [START_UID + (i % n_users) for i in range(n_updates)]
+    bodies = [make_update(next(_update_ids), s, i) for i, s in enumerate(senders)]
+    acks = []
+    statuses = {}
+    sem = asyncio.Semaphore(args.client_concurrency)
+
+    async with ClientSession() as http:
+        async def post(body):
+            async with sem:
+                t0 = time.perf_counter()
+                async with http.post(url, data=body, headers={"Content-Type": "application/json"}) as r:
+                    await r.read()
+                acks.append(time.perf_counter() - t0)
+                statuses[r.status] = statuses.get(r.status, 0) + 1
+
+        t_start = time.perf_counter()
+        await asyncio.gather(*(post(b) for b in bodies))
+        t_acked = time.perf_counter()
+        await bot_module.update_pipeline.join()
+        while bot_module._background_tasks:  # broadcasts fan out in background tasks
+            await asyncio.gather(*list(bot_module._background_tasks), return_exceptions=True)
+        t_done = time.perf_counter()
+
+    await runner.cleanup()
+
+    delivered = api.results["ok"] + api.results["forbidden"]
+    fanout_time = t_done - t_start
+    return {
+        "users": n_users,
+        "updates": n_updates,
+        "http_status": statuses,
+        "ingest_updates_per_s": n_updates / (t_acked - t_start) if t_acked > t_start else 0.0,
+        "ack_p50_ms": pct(acks, 0.50) * 1000,
+        "ack_p99_ms": pct(acks, 0.99) * 1000,
+        "fanout_msgs": delivered,
+        "fanout_429": api.results["flood"],
+        "fanout_msgs_per_s": delivered / fanout_time if fanout_time > 0 else 0.0,
+        "drain_s": fanout_time,
+    }
+
+
+def print_table(rows):
+    head = f"{'users':>8} {'updates':>8} {'upd/s':>9} {'ack p50':>9} {'ack p99':>9} {'msgs':>9} {'429s':>6} {'msgs/s':>9} {'drain':>8}"
+    print(head)
+    print("-" * len(head))
+    for r in rows:
+        print(f"{r['users']:>8} {r['updates']:>8} {r['ingest_updates_per_s']:>9.1f} {r['ack_p50_ms']:>7.2f}ms "
+              f"{r['ack_p99_ms']:>7.2f}ms {r['fanout_msgs']:>9} {r['fanout_429']:>6} "
+              f"{r['fanout_msgs_per_s']:>9.1f} {r['drain_s']:>7.2f}s")
+
+
+async def main_async(args):
+    api = FakeBotAPI(latency=args.api_latency, jitter=args.api_jitter, flood_prob=args.flood,
+                     retry_after=args.retry_after, blocked_ratio=args.blocked, max_rate=args.api_max_rate)
+    api_runner = await api.start()
+    workdir = tempfile.mkdtemp(prefix="anonbot-load-")
+    configure_env(args, api.url, workdir)
+
+    import bot as bot_module  # configured through the environment above
+
+    rows = []
+    try:
+        for n in args.users:
+            row = await run_scenario(bot_module, api, n, args)
+            rows.append(row)
+            print(f"users={n}: {row['updates']} updates drained in {row['drain_s']:.2f}s", file=sys.stderr)
+    finally:
+        await bot_module.bot.session.close()
+        await api_runner.cleanup()
+    return rows
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--users", type=int, nargs="+", default=[100, 1000, 10000])
+    ap.add_argument("--updates", type=int, default=20, help="webhook updates per scenario")
+    ap.add_argument("--client-concurrency", type=int, default=50, help="parallel webhook requests")
+    ap.add_argument("--send-rate", type=float, default=1e6, help="bot GLOBAL_SEND_RATE")
+    ap.add_argument("--chat-rate", type=float, default=1e6, help="bot PER_CHAT_SEND_RATE")
+    ap.add_argument("--concurrency", type=int, default=64, help="bot FANOUT_CONCURRENCY")
+    ap.add_argument("--api-latency", type=float, default=0.0)
+    ap.add_argument("--api-jitter", type=float, default=0.0)
+    ap.add_argument("--api-max-rate", type=float, default=None, help="fake API global limit (429 above)")
+    ap.add_argument("--flood", type=float, default=0.0, help="probability of an injected 429")
+    ap.add_argument("--retry-after", type=int, default=1)
+    ap.add_argument("--blocked", type=float, default=0.0, help="share of users that blocked the bot")
+    ap.add_argument("--fs-latency", type=float, default=0.0, help="fake Firestore RPC latency, seconds")
+    ap.add_argument("--fs-async", action="store_true", help="AsyncFirestoreStorage instead of the executor one")
+    ap.add_argument("--fs-channels", type=int, default=2, help="async clients with --fs-async")
+    ap.add_argument("--fs-concurrency", type=int, default=64, help="RPCs in flight with --fs-async")
+    ap.add_argument("--json", action="store_true", help="print results as JSON")
+    ap.add_argument("--scenario", choices=sorted(SCENARIOS), help="named scenario (overrides the options above)")
+    args = ap.parse_args()
+    for key, value in SCENARIOS.get(args.scenario, {}).items():
+        setattr(args, key, value)
+
+    rows = asyncio.run(main_async(args))
+    if args.json:
+        print(json.dumps(rows, indent=2))
+    else:
+        print()
+        print_table(rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+# benchmarks/send_path.py
+"""
+Micro-benchmark: client-side cost of one broadcast send.
+
+  aiogram - bot(SendMessage(...)) per recipient: method object + pydantic
+            validation + form encoding + full Message parsing of the answer
+  raw     - RawSender: body serialized once per broadcast, chat_id spliced
+            in, answer reduced to message_id
+
+Both talk to the fake Bot API running in a child process, so the CPU time
+measured here (time.process_time) is the bot's side only.
+
+Run:  python benchmarks/send_path.py [sends] [concurrency]
+"""
+import asyncio
+import os
+import socket
+import subprocess
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+from aiogram import Bot  # noqa: E402
+from aiogram.client.default import DefaultBotProperties  # noqa: E402
+from aiogram.client.session.aiohttp import AiohttpSession  # noqa: E402
+from aiogram.client.telegram import TelegramAPIServer  # noqa: E402
+from aiogram.methods import SendMessage  # noqa: E402
+
+from sender import RawSender  # noqa: E402
+
+TEXT = "<code>[ID1234567890]</code>\nпривет всем, это тестовое сообщение для замера"
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+async def wait_port(port: int, timeout: float = 30.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            _, w = await asyncio.open_connection("127.0.0.1", port)
+            w.close()
+            return
+        except OSError:
+            await asyncio.sleep(0.2)
+    raise RuntimeError("fake API did not start")
+
+
+async def run(label: str, send, n: int, concurrency: int):
+    sem = asyncio.Semaphore(concurrency)
+
+    async def one(rid):
+        async with sem:
+            await send(rid)
+
+    await asyncio.gather(*(one(1000 + i) for i in range(min(n, 200))))  # warm-up: connections, caches
+    cpu0, wall0 = time.process_time(), time.perf_counter()
+    await asyncio.gather(*(one(1000 + i) for i in range(n)))
+    cpu, wall = time.process_time() - cpu0, time.perf_counter() - wall0
+    print(f"{label:8} {n / wall:9.0f} sends/s   {cpu / n * 1e6:8.1f} us CPU/send")
+    return cpu / n
+
+
+async def main(n: int, concurrency: int):
+    port = free_port()
+    api = subprocess.Popen([sys.executable, os.path.join(HERE, "fake_api.py"), "--port", str(port)],
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        await wait_port(port)
+        url = f"http://127.0.0.1:{port}"
+        bot = Bot("123456:bench", session=AiohttpSession(api=TelegramAPIServer.from_base(url)),
+                  default=DefaultBotProperties(parse_mode="HTML"))
+        raw = RawSender(bot, pool_size=concurrency)
+        prepared = raw.prepare(SendMessage(chat_id=0, text=TEXT))
+
+        old = await run("aiogram", lambda rid: bot(SendMessage(chat_id=rid, text=TEXT)), n, concurrency)
+        new = await run("raw", lambda rid: raw.send(prepared, rid), n, concurrency)
+        print(f"CPU per send: {old / new:.1f}x less on the raw path")
+        await raw.close()
+        await bot.session.close()
+    finally:
+        api.terminate()
+        api.wait()
+
+
+if __name__ == "__main__":
+    sends = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    conc = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    asyncio.run(main(sends, conc))
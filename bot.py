@@ -1,29 +1,56 @@
 # bot.py
 import os
+import sys
 import json
 import html
+import logging
 import base64
 import asyncio
 import random
 import time
+_MODULE_STARTED = time.perf_counter()
+import math
+import bisect
+import dataclasses
+import re
+import signal
+import traceback
+import contextlib
 from datetime import datetime, timedelta
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Sequence
 
 from aiohttp import web
 from aiogram import Bot, Dispatcher
 from aiogram.client.default import DefaultBotProperties
-from aiogram.filters import CommandStart, Command
-from aiogram.types import Message, Update
-from aiogram.exceptions import TelegramForbiddenError
-
-# Optional: firebase-admin (if FIREBASE_CREDENTIALS_JSON provided)
-USE_FIREBASE = False
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.filters import CommandStart, Command, CommandObject
+from aiogram.methods import (SendMessage, SendPhoto, SendVideo, SendDocument, SendAnimation, SendVoice,
+                             SendAudio, SendSticker, SendMediaGroup, GetUpdates)
+from aiogram.types import (Message, Update, InputMediaPhoto, InputMediaVideo, InputMediaDocument,
+                           InputMediaAudio)
+from aiogram.exceptions import TelegramBadRequest
+
+from albums import AlbumBuffer
+from antispam import SpamGuard, DUPLICATE as SPAM_DUPLICATE, TOO_FAST as SPAM_TOO_FAST
+from cache import RecipientIndex, UserCache, RelayIndex, AnonIndex
+from cluster import Cluster, update_uid
+from digest import Coalescer, digest_text
+from fanout import FanoutEngine, InteractiveLane
+from metrics import REGISTRY, CONTENT_TYPE
+from outbox import Outbox, OutboxEntry, DeliveryCursor, SqliteOutbox, FirestoreOutbox
+from pipeline import UpdatePipeline, QUEUED, DUPLICATE
+from sender import RawSender
+import tracing
+from tracing import Trace, span
+from storage import Storage, FirestoreStorage, AsyncFirestoreStorage, JsonStorage, SqliteStorage, migrate_legacy
+
+# Optional: orjson for faster webhook decoding (stdlib json otherwise)
 try:
-    import firebase_admin
-    from firebase_admin import credentials, firestore
-    USE_FIREBASE = True
-except Exception:
-    USE_FIREBASE = False  # will check env at runtime
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
 
 # ========== CONFIG ==========
 BOT_TOKEN = os.getenv("BOT_TOKEN")
@@ -37,15 +64,29 @@ WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # e.g. https://anonim-bot-2chv.onrender.
 # security secret for webhook
 WEBHOOK_SECRET_TOKEN = os.getenv("WEBHOOK_SECRET_TOKEN")  # must match when setting webhook
 
-# Persistence files (local fallback)
+# Bot API server (self-hosted telegram-bot-api or the fake one in benchmarks/)
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")  # e.g. http://127.0.0.1:8081
+
+# Persistence (when Firestore is not configured)
+# STORAGE_BACKEND: sqlite (default) | json (legacy users.json + banned_users.txt)
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "sqlite").lower()
+SQLITE_PATH = os.getenv("SQLITE_PATH", "users.db")
 USERS_FILE = os.getenv("USERS_FILE", "users.json")
 BANNED_FILE = os.getenv("BANNED_FILE", "banned_users.txt")
 
+# Broadcast outbox (resume unfinished fan-outs after a restart)
+# OUTBOX_BACKEND: sqlite (default) | firestore (collection anon_bot_outbox) | none
+OUTBOX_BACKEND = os.getenv("OUTBOX_BACKEND", "sqlite").lower()
+OUTBOX_PATH = os.getenv("OUTBOX_PATH", "outbox.db")
+OUTBOX_FLUSH_INTERVAL = float(os.getenv("OUTBOX_FLUSH_INTERVAL", "1.0"))  # seconds between cursor saves
+
 # Limits & timings
 MAX_MESSAGE_LENGTH = int(os.getenv("MAX_MESSAGE_LENGTH", "250"))
 MAX_MEDIA_MB = int(os.getenv("MAX_MEDIA_MB", "20"))
 SPAM_INTERVAL = timedelta(minutes=int(os.getenv("SPAM_INTERVAL_MINUTES", "10")))
 SEND_INTERVAL = timedelta(seconds=int(os.getenv("SEND_INTERVAL_SECONDS", "3")))
+SEND_BURST = int(os.getenv("SEND_BURST", "1"))  # messages allowed back-to-back, refilled one per SEND_INTERVAL
+ALBUM_WINDOW = float(os.getenv("ALBUM_WINDOW", "1.0"))  # seconds to wait for the rest of a media album
 
 # Admins (comma-separated IDs if you want)
 ADMINS = set()
@@ -57,16 +98,80 @@ if os.getenv("ADMINS"):
 
 # Startup announce config (optional)
 STARTUP_ANNOUNCE = os.getenv("STARTUP_ANNOUNCE", "false").lower() in ("1", "true", "yes")
-STARTUP_SEND_DELAY = float(os.getenv("STARTUP_SEND_DELAY", "0.5"))  # seconds between startup DMs
+ANNOUNCE_PROGRESS_INTERVAL = float(os.getenv("ANNOUNCE_PROGRESS_INTERVAL", "10"))  # seconds between progress logs
 REASSIGN_ANON_ON_START = os.getenv("REASSIGN_ANON_ON_START", "false").lower() in ("1", "true", "yes")
 
+# Broadcast fan-out (Telegram: ~30 msg/s per bot, ~1 msg/s per chat)
+FANOUT_CONCURRENCY = int(os.getenv("FANOUT_CONCURRENCY", "20"))
+GLOBAL_SEND_RATE = float(os.getenv("GLOBAL_SEND_RATE", "30"))
+PER_CHAT_SEND_RATE = float(os.getenv("PER_CHAT_SEND_RATE", "1"))
+SEND_MAX_RETRIES = int(os.getenv("SEND_MAX_RETRIES", "3"))
+# relays: serialize the request once per broadcast and post it over a raw keep-alive pool
+FAST_SEND = os.getenv("FAST_SEND", "true").lower() in ("1", "true", "yes")
+SEND_POOL_SIZE = int(os.getenv("SEND_POOL_SIZE", "100"))  # connections to the Bot API
+# digest mode: merge text relays while more than COALESCE_BACKLOG_SECONDS of sends are queued (0 = never)
+COALESCE_BACKLOG_SECONDS = float(os.getenv("COALESCE_BACKLOG_SECONDS", "60"))
+COALESCE_MAX_DELAY = float(os.getenv("COALESCE_MAX_DELAY", "30"))  # longest a relay waits for its digest
+DIGEST_MAX_CHARS = 4096  # Telegram message length limit
+
+# Update pipeline: webhook acks immediately, workers feed the dispatcher
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", "8"))
+UPDATE_QUEUE_SIZE = int(os.getenv("UPDATE_QUEUE_SIZE", "1000"))
+UPDATE_DEDUPE_WINDOW = int(os.getenv("UPDATE_DEDUPE_WINDOW", "10000"))
+# what to do when the queue is full: "503" (Telegram retries later) or "shed" (ack and drop)
+QUEUE_FULL_POLICY = os.getenv("QUEUE_FULL_POLICY", "503").lower()
+
+# how updates come in: "webhook" (default) or "polling" (getUpdates; no public URL needed)
+UPDATE_MODE = os.getenv("UPDATE_MODE", "webhook").lower()
+POLL_TIMEOUT = int(os.getenv("POLL_TIMEOUT", "25"))  # getUpdates long-poll seconds
+POLL_LIMIT = int(os.getenv("POLL_LIMIT", "100"))  # updates per getUpdates (Bot API max 100)
+
+# webhook debug logging (headers/body dumps) — off by default, sampled when on
+WEBHOOK_LOG_LEVEL = os.getenv("WEBHOOK_LOG_LEVEL", "WARNING").upper()
+WEBHOOK_LOG_SAMPLE = float(os.getenv("WEBHOOK_LOG_SAMPLE", "0.01"))
+
+# multi-worker mode: WORKERS processes share PORT (SO_REUSEPORT); worker i owns users with uid % WORKERS == i
+WORKERS = int(os.getenv("WORKERS", "1"))
+WORKER_INDEX = int(os.getenv("WORKER_INDEX", "0"))
+CLUSTER_DIR = os.getenv("CLUSTER_DIR", f"/tmp/anonbot-{os.getenv('PORT', '10000')}")  # workers' unix sockets
+
+# keep the recipient index fresh with a Firestore snapshot listener (multi-instance setups)
+RECIPIENTS_WATCH = os.getenv("RECIPIENTS_WATCH", "false").lower() in ("1", "true", "yes")
+
+# user document cache (is_banned / ensure_user hot path)
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000"))
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "300"))
+
+# reverse lookups for admin commands: relayed copy -> sender, anon_id -> uid
+RELAY_INDEX_SIZE = int(os.getenv("RELAY_INDEX_SIZE", "200000"))
+ANON_INDEX_SIZE = int(os.getenv("ANON_INDEX_SIZE", "100000"))
+
+# Firestore access: native asyncio client (default) or the sync client on the executor
+FIRESTORE_ASYNC = os.getenv("FIRESTORE_ASYNC", "true").lower() in ("1", "true", "yes")
+FIRESTORE_CHANNELS = int(os.getenv("FIRESTORE_CHANNELS", "2"))  # AsyncClients (gRPC channels), used round-robin
+FIRESTORE_MAX_CONCURRENCY = int(os.getenv("FIRESTORE_MAX_CONCURRENCY", "64"))  # RPCs in flight
+FIRESTORE_BATCH_WINDOW_MS = float(os.getenv("FIRESTORE_BATCH_WINDOW_MS", "2"))  # merge reads into get_all
+FIRESTORE_BATCH_MAX = int(os.getenv("FIRESTORE_BATCH_MAX", "100"))
+
+# tracing: log updates slower than TRACE_SLOW_MS (webhook to handler done) with their span breakdown
+TRACE_SLOW_MS = float(os.getenv("TRACE_SLOW_MS", "500"))  # 0 = log every update
+PROFILE_MAX_SECONDS = float(os.getenv("PROFILE_MAX_SECONDS", "60"))  # upper bound for /profile
+PROFILE_TOP = int(os.getenv("PROFILE_TOP", "20"))  # functions in the /profile answer
+
+# threads for blocking calls (sync Firestore, legacy JSON files, outbox)
+EXECUTOR_THREADS = int(os.getenv("EXECUTOR_THREADS", "6"))
+
 # ----------------- Firebase init helper -----------------
 def init_firebase_if_env():
+    """Import and initialize firebase-admin (slow: runs on the executor during warm-up)."""
     raw = os.getenv("FIREBASE_CREDENTIALS_JSON")
     raw_b64 = os.getenv("FIREBASE_CREDENTIALS_BASE64")
     if not raw and not raw_b64:
         return False
-    if not USE_FIREBASE:
+    try:
+        import firebase_admin
+        from firebase_admin import credentials
+    except ImportError:
         raise RuntimeError("firebase-admin not installed but FIREBASE_CREDENTIALS_JSON provided. Add firebase-admin to requirements.")
     try:
         if raw:
@@ -82,120 +187,234 @@ def init_firebase_if_env():
     except Exception as e:
         raise RuntimeError("Failed to initialize Firebase: " + str(e))
 
+# set by init_backends() during warm-up
 FIRESTORE_ENABLED = False
-try:
-    FIRESTORE_ENABLED = init_firebase_if_env()
-except Exception as e:
-    print("Firebase init error:", e)
-    FIRESTORE_ENABLED = False
-
-if FIRESTORE_ENABLED:
-    db = firestore.client()
-    USERS_COL = db.collection("anon_bot_users")
-else:
-    USERS_COL = None
-
-# ========== Bot & Dispatcher ==========
-bot = Bot(token=BOT_TOKEN, default=DefaultBotProperties(parse_mode="HTML"))
-dp = Dispatcher()
-
-# ========== Helpers: local file persistence ==========
-def load_users_local() -> Dict[int, str]:
-    if not os.path.exists(USERS_FILE):
-        return {}
-    try:
-        with open(USERS_FILE, "r", encoding="utf-8") as f:
-            data = json.load(f)
-        return {int(k): v for k, v in data.items()}
-    except Exception as e:
-        print("Failed to load users.json:", e)
-        return {}
+db = None
+USERS_COL = None
 
-def save_users_local(users: Dict[int, str]):
-    tmp = USERS_FILE + ".tmp"
-    try:
-        with open(tmp, "w", encoding="utf-8") as f:
-            json.dump({str(k): v for k, v in users.items()}, f, ensure_ascii=False, indent=2)
-        os.replace(tmp, USERS_FILE)
-    except Exception as e:
-        print("Failed to save users.json:", e)
-
-def load_banned_local() -> set:
-    if not os.path.exists(BANNED_FILE):
-        return set()
-    try:
-        with open(BANNED_FILE, "r", encoding="utf-8") as f:
-            return set(int(line.strip()) for line in f if line.strip().isdigit())
-    except Exception as e:
-        print("Failed to load banned file:", e)
-        return set()
-
-def append_banned_local(uid: int):
-    try:
-        with open(BANNED_FILE, "a", encoding="utf-8") as f:
-            f.write(f"{uid}\n")
-    except Exception as e:
-        print("Failed to append banned:", e)
-
-def rewrite_banned_local(banned: set):
-    try:
-        with open(BANNED_FILE, "w", encoding="utf-8") as f:
-            for uid in banned:
-                f.write(f"{uid}\n")
-    except Exception as e:
-        print("Failed to write banned file:", e)
-
-# ========== Firestore helpers (blocking calls run in executor) ==========
+# ========== Storage backend ==========
 import functools, concurrent.futures
-_executor = concurrent.futures.ThreadPoolExecutor(max_workers=6)
+_executor = concurrent.futures.ThreadPoolExecutor(max_workers=EXECUTOR_THREADS)
 
 async def run_blocking(fn, *args, **kwargs):
     loop = asyncio.get_running_loop()
     return await loop.run_in_executor(_executor, functools.partial(fn, *args, **kwargs))
 
-def _get_user_doc_sync(uid: int):
-    doc = USERS_COL.document(str(uid)).get()
-    return doc.to_dict() if doc.exists else None
-
-async def get_user_doc(uid: int):
-    return await run_blocking(_get_user_doc_sync, uid)
+def async_user_collections():
+    """anon_bot_users on FIRESTORE_CHANNELS separate AsyncClients (one gRPC channel each)."""
+    import firebase_admin
+    from firebase_admin import firestore
+    app = firebase_admin.get_app()
+    cred, project = app.credential.get_credential(), app.project_id
+    return [firestore.AsyncClient(credentials=cred, project=project).collection("anon_bot_users")
+            for _ in range(max(1, FIRESTORE_CHANNELS))]
 
-def _set_user_doc_sync(uid:int, data: Dict[str,Any]):
-    USERS_COL.document(str(uid)).set(data)
+def create_storage() -> Storage:
+    if FIRESTORE_ENABLED:
+        if FIRESTORE_ASYNC:
+            print(f"Using Firestore (asyncio client, {FIRESTORE_CHANNELS} channels) for persistence")
+            return AsyncFirestoreStorage(async_user_collections(), max_concurrency=FIRESTORE_MAX_CONCURRENCY,
+                                         batch_window=FIRESTORE_BATCH_WINDOW_MS / 1000.0,
+                                         batch_max=FIRESTORE_BATCH_MAX,
+                                         on_batch=lambda n: STORAGE_READ_BATCH.observe(n))
+        print("Using Firestore for persistence")
+        return FirestoreStorage(USERS_COL, executor=_executor)
+    if STORAGE_BACKEND == "json":
+        print("Using local files for persistence (users.json). NOTE: file not persistent across redeploys!")
+        if WORKERS > 1:
+            print("WARNING: users.json is not shared between workers, use STORAGE_BACKEND=sqlite with WORKERS > 1")
+        return JsonStorage(USERS_FILE, BANNED_FILE)
+    store = SqliteStorage(SQLITE_PATH)
+    if store.is_empty() and (os.path.exists(USERS_FILE) or os.path.exists(BANNED_FILE)):
+        n = migrate_legacy(USERS_FILE, BANNED_FILE, SQLITE_PATH)
+        print(f"Migrated {n} users from {USERS_FILE} into {SQLITE_PATH}")
+    print(f"Using SQLite for persistence ({SQLITE_PATH}). NOTE: file not persistent across redeploys!")
+    return store
+
+storage: Storage = None  # created by init_backends()
+
+def create_outbox() -> Outbox:
+    if OUTBOX_BACKEND == "none":
+        return Outbox()
+    if OUTBOX_BACKEND == "firestore":
+        if FIRESTORE_ENABLED:
+            return FirestoreOutbox(db.collection("anon_bot_outbox"), executor=_executor)
+        print("OUTBOX_BACKEND=firestore needs Firestore credentials, using SQLite outbox")
+    return SqliteOutbox(OUTBOX_PATH)
+
+outbox: Outbox = None  # created by init_backends()
+
+# ========== Startup phases ==========
+STARTUP_PHASE_SECONDS = REGISTRY.gauge("anonbot_startup_phase_seconds", "Duration of each startup phase", ["phase"])
+startup_phases: Dict[str, float] = {}
+_backends_ready = asyncio.Event()  # storage + outbox usable
+_warm = False  # recipient index loaded, interrupted broadcasts resumed
+_webhook_state = "pending"
+_startup_failed = False
+
+def record_phase(name: str, seconds: float):
+    startup_phases[name] = seconds
+    STARTUP_PHASE_SECONDS.set(seconds, phase=name)
+    print(f"Startup: {name} {seconds:.2f}s")
+
+@contextlib.contextmanager
+def startup_phase(name: str):
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_phase(name, time.perf_counter() - t0)
+
+async def init_backends():
+    """Firebase, storage and outbox, off the event loop (imports and file loading block)."""
+    global FIRESTORE_ENABLED, db, USERS_COL, storage, outbox
+    if storage is None:
+        with startup_phase("firebase"):
+            try:
+                FIRESTORE_ENABLED = await run_blocking(init_firebase_if_env)
+            except Exception as e:
+                print("Firebase init error:", e)
+                FIRESTORE_ENABLED = False
+            if FIRESTORE_ENABLED:
+                from firebase_admin import firestore
+                db = await run_blocking(firestore.client)
+                USERS_COL = db.collection("anon_bot_users")
+        with startup_phase("storage"):
+            storage = await run_blocking(create_storage)
+    if outbox is None:
+        with startup_phase("outbox"):
+            outbox = await run_blocking(create_outbox)
+    _backends_ready.set()
+
+async def backends_ready():
+    if not _backends_ready.is_set():
+        await _backends_ready.wait()
+
+webhook_log = logging.getLogger("anonbot.webhook")
+webhook_log.setLevel(WEBHOOK_LOG_LEVEL)
+
+# ========== Metrics (/metrics, Prometheus text format) ==========
+WEBHOOK_ACK_SECONDS = REGISTRY.histogram("anonbot_webhook_ack_seconds", "Time from webhook request to response")
+STORAGE_CALL_SECONDS = REGISTRY.histogram("anonbot_storage_call_seconds", "Storage backend call latency", ["op"])
+BROADCAST_SECONDS = REGISTRY.histogram("anonbot_broadcast_duration_seconds", "Duration of one broadcast fan-out")
+SEND_SECONDS = REGISTRY.histogram("anonbot_send_seconds", "Latency of one Bot API send call")
+SENDS_TOTAL = REGISTRY.counter("anonbot_sends_total", "Per-recipient send results", ["status"])
+EXECUTOR_QUEUE = REGISTRY.gauge("anonbot_executor_queue_depth", "Blocking calls waiting for an executor thread",
+                                fn=lambda: _executor._work_queue.qsize())
+STORAGE_IN_FLIGHT = REGISTRY.gauge("anonbot_storage_in_flight", "Storage backend calls in flight",
+                                   fn=lambda: storage.in_flight)
+STORAGE_READ_BATCH = REGISTRY.histogram("anonbot_storage_read_batch_size", "User docs per get_all (async Firestore)",
+                                        buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500))
+UPDATE_QUEUE = REGISTRY.gauge("anonbot_update_queue_depth", "Updates waiting for a pipeline worker")
+ACTIVE_BROADCASTS = REGISTRY.gauge("anonbot_active_broadcasts", "Broadcasts currently fanning out")
+ANTISPAM_ENTRIES = REGISTRY.gauge("anonbot_antispam_entries", "Users currently tracked by the anti-spam guard")
+ANTISPAM_BYTES = REGISTRY.gauge("anonbot_antispam_memory_bytes", "Approximate memory held by the anti-spam guard")
 
-async def set_user_doc(uid:int, data: Dict[str,Any]):
-    return await run_blocking(_set_user_doc_sync, uid, data)
+# ========== Bot & Dispatcher ==========
+def create_bot_session():
+    if not TELEGRAM_API_URL:
+        return None
+    return AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL))
 
-def _update_user_doc_sync(uid:int, updates: Dict[str,Any]):
-    USERS_COL.document(str(uid)).update(updates)
+bot = Bot(token=BOT_TOKEN, session=create_bot_session(), default=DefaultBotProperties(parse_mode="HTML"))
+dp = Dispatcher()
+raw_sender = RawSender(bot, pool_size=SEND_POOL_SIZE)
+cluster = Cluster(WORKER_INDEX, WORKERS, CLUSTER_DIR)
+
+# the Bot API limit is per bot: every worker gets its share
+fanout = FanoutEngine(concurrency=FANOUT_CONCURRENCY, global_rate=GLOBAL_SEND_RATE / cluster.size,
+                      per_chat_rate=PER_CHAT_SEND_RATE, max_retries=SEND_MAX_RETRIES,
+                      on_result=lambda rid, status, result: SENDS_TOTAL.inc(status=status))
+ACTIVE_BROADCASTS.set_function(lambda: fanout.active_broadcasts)
+BROADCAST_SENDERS = REGISTRY.gauge("anonbot_broadcast_senders", "Senders with broadcasts in the fan-out",
+                                   fn=lambda: fanout.active_senders)
+# replies / admin acks made through the bot go ahead of broadcast traffic
+bot.session.middleware(InteractiveLane(fanout))
+
+coalescer = Coalescer(high=int(COALESCE_BACKLOG_SECONDS * GLOBAL_SEND_RATE / cluster.size),
+                      limit=DIGEST_MAX_CHARS, max_delay=COALESCE_MAX_DELAY)
+DIGEST_MODE = REGISTRY.gauge("anonbot_digest_mode", "1 while text relays are merged into digests",
+                             fn=lambda: int(coalescer.active))
+DIGEST_PENDING = REGISTRY.gauge("anonbot_digest_pending", "Text relays waiting for their digest",
+                                fn=lambda: coalescer.pending)
+COALESCED_TOTAL = REGISTRY.counter("anonbot_coalesced_relays_total", "Text relays delivered inside a digest")
+
+# ========== Storage access (cached) ==========
+user_cache = UserCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+anon_index = AnonIndex(maxsize=ANON_INDEX_SIZE)
 
-async def update_user_doc(uid:int, updates: Dict[str,Any]):
-    return await run_blocking(_update_user_doc_sync, uid, updates)
+async def get_user_doc(uid: int):
+    hit, doc = user_cache.get(uid)
+    if hit:
+        return doc
+    with STORAGE_CALL_SECONDS.time(op="get_user_doc"), span("storage.get_user_doc"):
+        doc = await storage.get_user(uid)
+    user_cache.put(uid, doc)
+    if doc:
+        anon_index.put(doc.get("anon_id"), uid)
+    return doc
 
-def _list_user_docs_sync():
-    docs = USERS_COL.stream()
-    out = []
-    for d in docs:
-        dd = d.to_dict()
-        dd["_doc_id"] = d.id
-        out.append(dd)
-    return out
+async def set_user_doc(uid:int, data: Dict[str,Any]):
+    with STORAGE_CALL_SECONDS.time(op="set_user_doc"), span("storage.set_user_doc"):
+        await storage.put_user(uid, data)
+    user_cache.put(uid, data)
+    anon_index.put(data.get("anon_id"), uid)
+    cluster.publish({"type": "users", "updates": {uid: data}})
+
+async def update_user_doc(uid:int, updates: Dict[str,Any]) -> bool:
+    """False if the user has no document yet."""
+    with STORAGE_CALL_SECONDS.time(op="update_user_doc"), span("storage.update_user_doc"):
+        ok = await storage.update_user(uid, updates)
+    if ok:
+        user_cache.update(uid, updates)
+        anon_index.put(updates.get("anon_id"), uid)
+        cluster.publish({"type": "users", "updates": {uid: updates}})
+    return ok
+
+async def find_uid_by_anon(anon_id: str):
+    uid = anon_index.get(anon_id)
+    if uid is None:
+        with STORAGE_CALL_SECONDS.time(op="find_by_anon"), span("storage.find_by_anon"):
+            uid = await storage.find_by_anon(anon_id)
+        if uid is not None:
+            anon_index.put(anon_id, uid)
+    return uid
 
 async def list_user_docs():
-    return await run_blocking(_list_user_docs_sync)
+    with STORAGE_CALL_SECONDS.time(op="list_user_docs"), span("storage.list_user_docs"):
+        return await storage.list_users()
 
 # ========== runtime state ==========
-if FIRESTORE_ENABLED:
-    print("Using Firestore for persistence")
-    local_users = {}
-    banned_users = set()
-else:
-    print("Using local files for persistence (users.json). NOTE: file not persistent across redeploys!")
-    local_users = load_users_local()
-    banned_users = load_banned_local()
-
-# in-memory last-message metadata (not persisted)
-user_last_message: Dict[int, Any] = {}
+# recipients of broadcasts, loaded once and maintained by the write paths below
+recipient_index = RecipientIndex()
+_recipient_load_lock = asyncio.Lock()
+_recipient_watch = None
+
+# relayed copies -> original sender (filled by the fan-out, for /ban in reply to a copy)
+relay_index = RelayIndex(maxsize=RELAY_INDEX_SIZE)
+
+# background tasks (keep references so they are not garbage-collected mid-run)
+_background_tasks = set()
+
+def _task_done(task: asyncio.Task):
+    _background_tasks.discard(task)
+    if task.cancelled():
+        return
+    e = task.exception()
+    if e is not None:
+        print(f"Background task {task.get_coro().__qualname__} failed: {e!r}")
+        traceback.print_exception(e)
+
+def spawn(coro):
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_task_done)
+    return task
+
+# in-memory anti-spam state (not persisted, expires on its own)
+spam_guard = SpamGuard(SPAM_INTERVAL.total_seconds(), SEND_INTERVAL.total_seconds(), SEND_BURST)
+ANTISPAM_ENTRIES.set_function(lambda: len(spam_guard))
+ANTISPAM_BYTES.set_function(spam_guard.memory_bytes)
 
 # ========== utility functions ==========
 def generate_anon_id() -> str:
@@ -206,75 +425,413 @@ def sanitize_text(text: str) -> str:
         return ""
     return html.escape(text.strip())
 
+def new_user_doc(anon: str, **extra) -> Dict[str,Any]:
+    data = {"anon_id": anon, "created_at": datetime.utcnow().timestamp(), "banned": False, "last_send": 0.0, "last_message": ""}
+    data.update(extra)
+    return data
+
 async def ensure_user(uid: int) -> Dict[str,Any]:
-    if FIRESTORE_ENABLED:
+    with span("ensure_user"):
         doc = await get_user_doc(uid)
-        if doc:
+        if doc and doc.get("anon_id"):
             return doc
-        anon = generate_anon_id()
-        data = {"anon_id": anon, "created_at": datetime.utcnow().timestamp(), "banned": False, "last_send": 0.0, "last_message": ""}
+        data = new_user_doc(generate_anon_id(), banned=bool(doc and doc.get("banned")))
         await set_user_doc(uid, data)
+        recipient_index.add(uid)
         return data
-    else:
-        if uid in local_users:
-            return {"anon_id": local_users[uid], "banned": False, "last_send": 0.0, "last_message": ""}
-        anon = generate_anon_id()
-        local_users[uid] = anon
-        save_users_local(local_users)
-        return {"anon_id": anon, "banned": False, "last_send": 0.0, "last_message": ""}
 
 async def set_user_anon(uid:int, new_anon:str):
-    """Установить anon_id пользователю (Firestore или локально)."""
-    if FIRESTORE_ENABLED:
-        try:
-            await update_user_doc(uid, {"anon_id": new_anon, "last_send": 0.0, "last_message": ""})
-        except Exception:
-            # если doc не существует — создадим
-            await set_user_doc(uid, {"anon_id": new_anon, "created_at": datetime.utcnow().timestamp(), "banned": False, "last_send": 0.0, "last_message": ""})
-    else:
-        local_users[uid] = new_anon
-        save_users_local(local_users)
+    """Установить anon_id пользователю."""
+    if not await update_user_doc(uid, {"anon_id": new_anon, "last_send": 0.0, "last_message": ""}):
+        # если doc не существует — создадим
+        await set_user_doc(uid, new_user_doc(new_anon))
+    recipient_index.add(uid)
 
 async def mark_banned(uid:int):
-    if FIRESTORE_ENABLED:
-        try:
-            await update_user_doc(uid, {"banned": True})
-        except Exception:
-            await set_user_doc(uid, {"anon_id": generate_anon_id(), "banned": True, "created_at": datetime.utcnow().timestamp()})
-    else:
-        banned_users.add(uid)
-        append_banned_local(uid)
+    if not await update_user_doc(uid, {"banned": True}):
+        await set_user_doc(uid, new_user_doc(generate_anon_id(), banned=True))
+    recipient_index.ban(uid)
 
 async def mark_unbanned(uid:int):
-    if FIRESTORE_ENABLED:
+    if not await update_user_doc(uid, {"banned": False}):
+        print("Failed to unban: no such user", uid)
+    recipient_index.unban(uid)
+
+# --- unreachable recipients (blocked the bot / deleted account) ---
+_inactive_pending: set = set()
+_inactive_flush = None
+
+def mark_inactive(uid: int):
+    """Drop uid from fan-outs right away; the storage flag is written in batches."""
+    global _inactive_flush
+    recipient_index.deactivate(uid)
+    user_cache.update(uid, {"inactive": True})
+    _inactive_pending.add(uid)
+    if _inactive_flush is None or _inactive_flush.done():
+        _inactive_flush = spawn(_flush_inactive())
+
+async def _flush_inactive(delay: float = 1.0):
+    await asyncio.sleep(delay)  # collect the burst of 403s of one broadcast
+    while _inactive_pending:
+        batch = {uid: {"inactive": True} for uid in _inactive_pending}
+        _inactive_pending.clear()
         try:
-            await update_user_doc(uid, {"banned": False})
+            with STORAGE_CALL_SECONDS.time(op="bulk_update"), span("storage.bulk_update"):
+                await storage.bulk_update(batch)
+            cluster.publish({"type": "users", "updates": batch})
+            print(f"Marked {len(batch)} users inactive")
         except Exception as e:
-            print("Failed to unban in firestore:", e)
-    else:
-        banned_users.discard(uid)
-        rewrite_banned_local(banned_users)
+            print("Failed to store inactive users:", e)
 
-async def get_all_recipients() -> List[int]:
-    if FIRESTORE_ENABLED:
+async def reactivate_if_needed(uid: int, doc: Dict[str, Any]):
+    if doc.get("inactive") or recipient_index.is_inactive(uid):
+        _inactive_pending.discard(uid)
+        await update_user_doc(uid, {"inactive": False})
+        recipient_index.reactivate(uid)
+        print(f"User {uid} is reachable again")
+
+def is_unreachable(status: str, result: Any) -> bool:
+    if status == "forbidden":  # bot blocked, user deactivated
+        return True
+    return isinstance(result, TelegramBadRequest) and "chat not found" in str(result).lower()
+
+async def load_recipient_index(warm_cache: bool = False):
+    """
+    Fill the recipient index from storage (one full read per process); with
+    ``warm_cache`` the most recent senders also go into the user cache.
+    """
+    global _recipient_watch
+    async with _recipient_load_lock:
+        if recipient_index.loaded:
+            return
         docs = await list_user_docs()
-        out = []
-        for d in docs:
-            try:
-                if not d.get("banned", False):
-                    out.append(int(d["_doc_id"]))
-            except Exception:
-                pass
-        return out
-    else:
-        return [uid for uid in local_users.keys() if uid not in banned_users]
+        recipient_index.load(docs)
+        for uid, doc in docs:
+            anon_index.put(doc.get("anon_id"), uid)
+        if warm_cache:
+            recent = sorted(docs, key=lambda d: d[1].get("last_send") or 0.0, reverse=True)
+            for uid, doc in reversed(recent[:USER_CACHE_SIZE]):
+                user_cache.put(uid, doc)
+        if RECIPIENTS_WATCH and FIRESTORE_ENABLED and _recipient_watch is None:
+            _recipient_watch = recipient_index.watch(USERS_COL)
+        print("Recipient index loaded:", len(recipient_index), "recipients")
+
+async def get_all_recipients() -> Sequence[int]:
+    with span("get_all_recipients"):
+        if not recipient_index.loaded:
+            await load_recipient_index()
+        return recipient_index.recipients()
 
 async def is_banned(uid:int) -> bool:
-    if FIRESTORE_ENABLED:
+    with span("is_banned"):
         doc = await get_user_doc(uid)
-        return bool(doc.get("banned", False)) if doc else False
+    return bool(doc.get("banned", False)) if doc else False
+
+# ========== Relay payloads ==========
+# kind -> (Bot API method, name of the file argument)
+MEDIA_SENDERS = {
+    "photo": (SendPhoto, "photo"),
+    "video": (SendVideo, "video"),
+    "document": (SendDocument, "document"),
+    "animation": (SendAnimation, "animation"),
+    "voice": (SendVoice, "voice"),
+    "audio": (SendAudio, "audio"),
+    "sticker": (SendSticker, "sticker"),
+}
+
+# album item kind -> InputMedia type (albums only hold these)
+ALBUM_MEDIA = {
+    "photo": InputMediaPhoto,
+    "video": InputMediaVideo,
+    "document": InputMediaDocument,
+    "audio": InputMediaAudio,
+}
+
+def build_payload(message: Message, kind: str, caption: str) -> Dict[str, Any]:
+    """Describe what has to be relayed once, so the per-recipient send does no parsing."""
+    if kind == "text":
+        return {"kind": "text", "text": caption}
+    if kind == "caption":
+        # media with a caption: relay the media itself
+        for media in ("photo", "video", "document", "animation", "voice", "audio"):
+            if getattr(message, media):
+                kind = media
+                break
+        else:
+            return {"kind": "text", "text": caption}
+    obj = message.photo[-1] if kind == "photo" else getattr(message, kind)
+    return {"kind": kind, "file_id": obj.file_id, "caption": None if kind == "sticker" else caption}
+
+def build_album_payload(messages: List[Message], header: str) -> Dict[str, Any]:
+    """One sendMediaGroup for the whole album; the anon header goes on the first item's caption."""
+    items = []
+    for message in messages:
+        kind = next((k for k in ALBUM_MEDIA if getattr(message, k)), None)
+        if kind is None:
+            continue
+        obj = message.photo[-1] if kind == "photo" else getattr(message, kind)
+        caption = sanitize_text(message.caption) if message.caption else None
+        if not items:
+            caption = header + (caption or "")
+        items.append({"type": kind, "file_id": obj.file_id, "caption": caption})
+    return {"kind": "album", "items": items}
+
+def build_method(payload: Dict[str, Any], chat_id: int):
+    kind = payload["kind"]
+    if kind == "album":
+        return SendMediaGroup(chat_id=chat_id, media=[
+            ALBUM_MEDIA[item["type"]](media=item["file_id"], caption=item["caption"])
+            for item in payload["items"]])
+    if kind == "text":
+        return SendMessage(chat_id=chat_id, text=payload["text"])
+    if kind == "digest":
+        return SendMessage(chat_id=chat_id, text=digest_text(payload["parts"]))
+    method, arg = MEDIA_SENDERS[kind]
+    kwargs = {"chat_id": chat_id, arg: payload["file_id"]}
+    if payload.get("caption") is not None:
+        kwargs["caption"] = payload["caption"]
+    return method(**kwargs)
+
+async def send_payload(payload: Dict[str, Any], rid: int, trace: Trace = None):
+    with SEND_SECONDS.time(), span("send", trace):
+        return await bot(build_method(payload, rid))
+
+def relay_sender(payload: Dict[str, Any]):
+    """send(rid) for one broadcast: serialized once and posted raw (FAST_SEND), or via aiogram per recipient."""
+    if payload["kind"] == "digest":
+        return digest_sender(payload)
+    trace = tracing.current()  # sends run in fan-out workers, outside the update's context
+    if not FAST_SEND:
+        return functools.partial(send_payload, payload, trace=trace)
+    prepared = raw_sender.prepare(build_method(payload, 0))
+
+    async def send(rid: int):
+        with SEND_SECONDS.time(), span("send", trace):
+            return await raw_sender.send(prepared, rid)
+    return send
+
+def digest_sender(payload: Dict[str, Any]):
+    """Like relay_sender; the authors of the digest get it without their own parts."""
+    common = relay_sender({"kind": "text", "text": digest_text(payload["parts"])})
+    authors = {p["sender"] for p in payload["parts"]}
+    trace = tracing.current()
+
+    async def send(rid: int):
+        if rid not in authors:
+            return await common(rid)
+        text = digest_text(payload["parts"], exclude=rid)
+        return await send_payload({"kind": "text", "text": text}, rid, trace) if text else None
+    return send
+
+def handle_send_result(rid: int, status: str, result: Any):
+    if is_unreachable(status, result):
+        print(f"{rid} is unreachable ({result}) — marking inactive.")
+        mark_inactive(rid)
+    elif status == "error":
+        print(f"Error sending to {rid}: {result}")
+
+def broadcast_shard(payload: Dict[str, Any]):
+    """
+    (shard, shards) of a multi-worker outbox entry: it covers the recipients with
+    uid % shards == shard, ``shards`` being the worker count it was split for.
+    None for an entry covering everyone.
+    """
+    if payload.get("shard") is None:
+        return None
+    return payload["shard"], payload.get("shards") or cluster.size  # entries from before "shards" was stored
+
+async def deliver_broadcast(entry: OutboxEntry, send=None, progress: str = None):
+    """
+    Fan out an outbox entry to every recipient after its cursor, then drop it from the outbox.
+    ``send(rid)`` defaults to relaying entry.payload; with ``progress`` set, progress is logged
+    every ANNOUNCE_PROGRESS_INTERVAL seconds under that name.
+    """
+    recipients = await get_all_recipients()  # sorted by uid
+    start = bisect.bisect_right(recipients, entry.cursor)
+    tracker = DeliveryCursor(entry.cursor)
+    sender = entry.sender
+    split = broadcast_shard(entry.payload)  # multi-worker mode: its own shard of the recipients
+    shard, shards = split or (None, 1)
+    total = (len(recipients) - start) // shards
+    handled = 0
+
+    def targets():
+        for i in range(start, len(recipients)):
+            rid = recipients[i]
+            if rid != sender and (shard is None or rid % shards == shard):
+                tracker.issue(rid)
+                yield rid
+
+    def on_result(rid: int, status: str, result: Any):
+        nonlocal handled
+        handled += 1
+        handle_send_result(rid, status, result)
+        if status == "sent" and sender:
+            for sent in (result if isinstance(result, list) else (result,)):
+                message_id = getattr(sent, "message_id", None)
+                if message_id is not None:
+                    relay_index.add(rid, message_id, sender)
+        tracker.done(rid)
+
+    async def report_progress():
+        t0 = time.monotonic()
+        while True:
+            await asyncio.sleep(ANNOUNCE_PROGRESS_INTERVAL)
+            rate = handled / (time.monotonic() - t0)
+            eta = (total - handled) / rate if rate > 0 else float("inf")
+            print(f"{progress}: {handled}/{total} ({handled * 100 // max(total, 1)}%), {rate:.1f} msg/s, ETA {eta:.0f}s")
+
+    async def save_cursor():
+        try:
+            await outbox.advance(entry.id, tracker.cursor)
+        except Exception as e:
+            print(f"Outbox: failed to save cursor of {entry.id}: {e}")
+
+    async def flush_periodically():
+        saved = entry.cursor
+        while True:
+            await asyncio.sleep(OUTBOX_FLUSH_INTERVAL)
+            if tracker.cursor != saved:
+                saved = tracker.cursor
+                await save_cursor()
+
+    flusher = asyncio.create_task(flush_periodically())
+    reporter = asyncio.create_task(report_progress()) if progress else None
+    try:
+        stats = await fanout.broadcast(targets(), send or relay_sender(entry.payload),
+                                       label=progress or entry.id[:8], on_result=on_result, owner=sender,
+                                       size=total)
+    finally:
+        flusher.cancel()
+        if reporter is not None:
+            reporter.cancel()
+        if tracker.cursor != entry.cursor:
+            await save_cursor()
+    try:
+        await outbox.complete(entry.id)
+    except Exception as e:
+        print(f"Outbox: failed to remove finished broadcast {entry.id}: {e}")
+    BROADCAST_SECONDS.observe(stats.elapsed)
+    trace = tracing.current()
+    if trace is not None:
+        print(f"{stats.summary()} [update {trace.update_id}: {trace.breakdown()}]")
     else:
-        return uid in banned_users
+        print(stats.summary())
+    return stats
+
+async def resume_outbox() -> List[OutboxEntry]:
+    """Restart unfinished relays; returns unfinished startup announces (they need their own sender)."""
+    try:
+        entries = await outbox.pending()
+    except Exception as e:
+        print("Outbox: failed to read unfinished broadcasts:", e)
+        return []
+    announces = []
+    for entry in entries:
+        # a shard split for another worker count (WORKERS changed) still goes to
+        # exactly one worker and keeps its own recipients
+        shard, shards = broadcast_shard(entry.payload) or (0, cluster.size)
+        if shard % cluster.size != cluster.index:
+            continue  # another worker's shard
+        if shards != cluster.size:
+            print(f"Outbox: {entry.id} was split for {shards} workers, delivering its shard {shard} here")
+        if entry.payload.get("kind") == "announce":
+            announces.append(entry)
+            continue
+        print(f"Outbox: resuming broadcast {entry.id} from {entry.sender} after uid {entry.cursor}")
+        spawn(deliver_broadcast(entry))
+    return announces
+
+async def create_broadcasts(sender: int, payload: Dict[str, Any]) -> OutboxEntry:
+    """
+    Record a new broadcast in the outbox and return the entry to deliver here.
+    In multi-worker mode there is one entry per recipient shard; the other
+    shards are handed to the workers that own them.
+    """
+    local = None
+    for shard in (range(cluster.size) if cluster.enabled else (None,)):
+        data = payload if shard is None else {**payload, "shard": shard, "shards": cluster.size}
+        try:
+            entry = await outbox.create(sender, data)
+        except Exception as e:
+            print("Outbox write failed, broadcasting without it:", e)
+            entry = Outbox.new_entry(sender, data)
+        if shard is None or shard == cluster.index:
+            local = entry
+        else:
+            cluster.send(shard, {"type": "broadcast", "entry": dataclasses.asdict(entry)})
+    return local
+
+def submit_broadcast(entry: OutboxEntry):
+    """Deliver an outbox entry, or hold a text relay for a digest while the fan-out is overloaded."""
+    if entry.payload.get("kind") == "text" and coalescer.update(fanout.backlog):
+        batch = coalescer.add(broadcast_shard(entry.payload), entry)
+        if batch:
+            spawn(deliver_digest(batch))
+        global _digest_watcher
+        if _digest_watcher is None or _digest_watcher.done():
+            _digest_watcher = spawn(watch_digests())
+        return
+    spawn(deliver_broadcast(entry))
+
+_digest_watcher = None
+
+async def watch_digests():
+    """Send held digests once they are COALESCE_MAX_DELAY old or the backlog is gone."""
+    while coalescer.pending or coalescer.active:
+        await asyncio.sleep(0.5)
+        for _, batch in coalescer.take(force=not coalescer.update(fanout.backlog)):
+            spawn(deliver_digest(batch))
+
+async def deliver_digest(entries: List[OutboxEntry]):
+    """
+    Merge held text relays into one outbox entry and broadcast it. The originals
+    stay in the outbox until the digest is recorded, so a crash in between
+    relays them one by one instead of losing them.
+    """
+    tracing.activate(None)  # a digest belongs to no single update
+    if len(entries) == 1:
+        return await deliver_broadcast(entries[0])
+    payload = {"kind": "digest", "parts": [{"sender": e.sender, "text": e.payload["text"]} for e in entries]}
+    split = broadcast_shard(entries[0].payload)
+    if split is not None:
+        payload["shard"], payload["shards"] = split
+    try:
+        digest = await outbox.create(0, payload)
+    except Exception as e:
+        print("Outbox write failed, broadcasting the digest without it:", e)
+        digest = Outbox.new_entry(0, payload)
+    for e in entries:
+        try:
+            await outbox.complete(e.id)
+        except Exception as ex:
+            print(f"Outbox: failed to remove merged relay {e.id}: {ex}")
+    COALESCED_TOTAL.inc(len(entries))
+    print(f"Digest: {len(entries)} relays in one message ({len(digest_text(payload['parts']))} chars)")
+    return await deliver_broadcast(digest)
+
+async def on_cluster_event(event: Dict[str, Any]):
+    """Changes made by another worker (its storage write is already done)."""
+    await backends_ready()
+    kind = event.get("type")
+    if kind == "users":
+        for key, updates in event["updates"].items():
+            uid = int(key)
+            user_cache.invalidate(uid)
+            anon_index.put(updates.get("anon_id"), uid)
+            recipient_index.add(uid)
+            if "banned" in updates:
+                (recipient_index.ban if updates["banned"] else recipient_index.unban)(uid)
+            if "inactive" in updates:
+                (recipient_index.deactivate if updates["inactive"] else recipient_index.reactivate)(uid)
+    elif kind == "users_reset":
+        user_cache.clear()
+    elif kind == "broadcast":
+        entry = OutboxEntry(**event["entry"])
+        if entry.payload.get("kind") == "announce":
+            spawn(reassign_and_notify_all(entry))
+        else:
+            submit_broadcast(entry)
 
 # ========== Handlers ==========
 @dp.message(CommandStart())
@@ -284,11 +841,132 @@ async def cmd_start(message: Message):
         await message.answer("🚫 Вы заблокированы и не можете участвовать.")
         return
     data = await ensure_user(uid)
+    await reactivate_if_needed(uid, data)
     anon = data.get("anon_id")
     # answer and log
     await message.answer(f"👋 Добро пожаловать в анонимный чатик.\nВаш новый анонимный ID:\n<code>[{anon}]</code>\n\nОтправь сообщение, чтобы его увидели другие участники.")
     print(f"/start from {uid} -> anon {anon}")
 
+# --- admin commands ---
+ANON_ID_RE = re.compile(r"\b(ID\d{10})\b")
+AMBIGUOUS_TARGET = -1  # reply to a message naming several users (a digest)
+
+async def resolve_target(message: Message, args: str = None):
+    """
+    Target of /ban and /unban: an ``ID…`` or numeric uid argument, or the
+    message replied to. A reply to a relayed copy (sent by the bot) resolves
+    through the relay index, then through the ``[ID…]`` tag in its text;
+    AMBIGUOUS_TARGET if the text names several users (digests are not in the
+    relay index).
+    """
+    if args:
+        arg = args.strip().strip("[]")
+        if arg.isdigit():
+            return int(arg)
+        m = ANON_ID_RE.search(arg)
+        return await find_uid_by_anon(m.group(1)) if m else None
+    reply = message.reply_to_message
+    if not reply:
+        return None
+    if not (reply.from_user and reply.from_user.is_bot):
+        return reply.from_user.id if reply.from_user else None
+    uid = relay_index.get(message.chat.id, reply.message_id)
+    if uid is None:
+        tags = set(ANON_ID_RE.findall(reply.text or reply.caption or ""))
+        if len(tags) > 1:
+            return AMBIGUOUS_TARGET
+        if tags:
+            uid = await find_uid_by_anon(tags.pop())
+    return uid
+
+@dp.message(Command(commands=["ban"]))
+async def cmd_ban(message: Message, command: CommandObject):
+    if message.from_user.id not in ADMINS:
+        return
+    if not command.args and not message.reply_to_message:
+        await message.reply("Ответьте командой на сообщение пользователя или укажите ID: /ban ID1234567890")
+        return
+    target_id = await resolve_target(message, command.args)
+    if target_id == AMBIGUOUS_TARGET:
+        await message.reply("В сообщении несколько ID — укажите нужный: /ban ID1234567890")
+        return
+    if target_id is None:
+        await message.reply("Не удалось определить отправителя.")
+        return
+    await mark_banned(target_id)
+    await message.reply(f"Пользователь {target_id} заблокирован (и будет игнорироваться).")
+
+@dp.message(Command(commands=["unban"]))
+async def cmd_unban(message: Message, command: CommandObject):
+    if message.from_user.id not in ADMINS:
+        return
+    if not command.args and not message.reply_to_message:
+        await message.reply("Ответьте командой на сообщение пользователя или укажите ID: /unban ID1234567890")
+        return
+    target_id = await resolve_target(message, command.args)
+    if target_id == AMBIGUOUS_TARGET:
+        await message.reply("В сообщении несколько ID — укажите нужный: /unban ID1234567890")
+        return
+    if target_id is None:
+        await message.reply("Не удалось определить отправителя.")
+        return
+    await mark_unbanned(target_id)
+    await message.reply(f"Пользователь {target_id} разбанен.")
+
+@dp.message(Command(commands=["profile"]))
+async def cmd_profile(message: Message, command: CommandObject):
+    if message.from_user.id not in ADMINS:
+        return
+    try:
+        seconds = float(command.args) if command.args else 10.0
+    except ValueError:
+        await message.reply("Использование: /profile [секунд]")
+        return
+    if tracing.is_profiling():
+        await message.reply("Профилирование уже идёт.")
+        return
+    seconds = max(1.0, min(seconds, PROFILE_MAX_SECONDS))
+    await message.reply(f"⏱ Профилирую {seconds:.0f} сек…")
+    # in the background: the pipeline worker must not sit out the whole window
+    spawn(run_profile(message, seconds))
+
+async def run_profile(message: Message, seconds: float):
+    tracing.activate(None)
+    try:
+        report = await tracing.profile(seconds, top=PROFILE_TOP)
+    except RuntimeError as e:
+        await message.reply(f"Не удалось профилировать: {e}")
+        return
+    print(f"Profile ({seconds:.0f}s):\n{report}")
+    table = tracing.top_functions(report)
+    await message.reply(f"<pre>{html.escape(table[:3900])}</pre>")
+
+@dp.message(Command(commands=["stats"]))
+async def cmd_stats(message: Message):
+    if message.from_user.id not in ADMINS:
+        return
+    if not recipient_index.loaded:
+        await load_recipient_index()
+    c = recipient_index.counts()
+    cs = user_cache.stats()
+    await message.reply(
+        f"👥 Пользователей: {c['total']}\n"
+        f"✅ Активных: {c['active']}\n"
+        f"💤 Неактивных (бот заблокирован): {c['inactive']}\n"
+        f"🚫 Забанено: {c['banned']}\n"
+        f"cache: {cs['size']} docs, hit ratio {cs['hit_ratio']:.0%}")
+
+def media_size_error(message: Message):
+    """Reply text if the message carries a file over MAX_MEDIA_MB, else None."""
+    limit = MAX_MEDIA_MB * 1024 * 1024
+    if message.photo and getattr(message.photo[-1], "file_size", 0) and message.photo[-1].file_size > limit:
+        return f"⚠️ Фото слишком большое (макс {MAX_MEDIA_MB} МБ)."
+    if message.document and getattr(message.document, "file_size", 0) and message.document.file_size > limit:
+        return f"⚠️ Файл слишком большой (макс {MAX_MEDIA_MB} МБ)."
+    if message.video and getattr(message.video, "file_size", 0) and message.video.file_size > limit:
+        return f"⚠️ Видео слишком большое (макс {MAX_MEDIA_MB} МБ)."
+    return None
+
 @dp.message()
 async def all_msg_handler(message: Message):
     # only private
@@ -296,11 +974,16 @@ async def all_msg_handler(message: Message):
         return
 
     uid = message.from_user.id
+    if message.media_group_id:
+        # checked and relayed as a whole once the album is complete
+        album_buffer.add(uid, message)
+        return
     if await is_banned(uid):
         await message.answer("🚫 Вы заблокированы.")
         return
 
     user_doc = await ensure_user(uid)
+    await reactivate_if_needed(uid, user_doc)
     anon_id = user_doc.get("anon_id") if user_doc else None
 
     # type and text
@@ -339,26 +1022,23 @@ async def all_msg_handler(message: Message):
         return
 
     # spam/interval checks
-    last = user_last_message.get(uid)
-    if last:
-        last_text, last_time, last_send_time = last
-        if kind in ("text","caption") and text == last_text and datetime.utcnow() - last_time < SPAM_INTERVAL:
-            await message.reply("⚠️ Нельзя.")
-            return
-        if last_send_time and datetime.utcnow() - last_send_time < SEND_INTERVAL:
-            await message.reply(f"⚠️ Подожди {int(SEND_INTERVAL.total_seconds())} сек перед следующим сообщением.")
-            return
+    spam_text = text if kind in ("text","caption") else None
+    verdict = spam_guard.check(uid, spam_text)
+    if verdict == SPAM_DUPLICATE:
+        await message.reply("⚠️ Нельзя.")
+        return
+    if verdict == SPAM_TOO_FAST:
+        wait = max(1, math.ceil(spam_guard.retry_in(uid)))
+        await message.reply(f"⚠️ Подожди {wait} сек перед следующим сообщением.")
+        return
 
     # media size checks
-    if message.photo and getattr(message.photo[-1], "file_size", 0) and message.photo[-1].file_size > MAX_MEDIA_MB * 1024 * 1024:
-        await message.reply(f"⚠️ Фото слишком большое (макс {MAX_MEDIA_MB} МБ)."); return
-    if message.document and getattr(message.document, "file_size", 0) and message.document.file_size > MAX_MEDIA_MB * 1024 * 1024:
-        await message.reply(f"⚠️ Файл слишком большой (макс {MAX_MEDIA_MB} МБ)."); return
-    if message.video and getattr(message.video, "file_size", 0) and message.video.file_size > MAX_MEDIA_MB * 1024 * 1024:
-        await message.reply(f"⚠️ Видео слишком большое (макс {MAX_MEDIA_MB} МБ)."); return
+    error = media_size_error(message)
+    if error:
+        await message.reply(error); return
 
     # update last
-    user_last_message[uid] = (text if kind in ("text","caption") else kind, datetime.utcnow(), datetime.utcnow())
+    spam_guard.record(uid, spam_text)
 
     # console output for reception
     print(f"[TelegramID: {uid} | ChatID: {anon_id}] -> {text if kind in ('text','caption') else kind}")
@@ -368,128 +1048,292 @@ async def all_msg_handler(message: Message):
     if kind in ("text","caption"):
         caption += text
 
-    # get recipients
-    recipients = await get_all_recipients()
-    for rid in recipients:
-        if rid == uid:
-            continue
-        try:
-            if kind == "text":
-                await bot.send_message(chat_id=rid, text=caption)
-            elif kind == "photo":
-                await bot.send_photo(chat_id=rid, photo=message.photo[-1].file_id, caption=caption)
-            elif kind == "video":
-                await bot.send_video(chat_id=rid, video=message.video.file_id, caption=caption)
-            elif kind == "document":
-                await bot.send_document(chat_id=rid, document=message.document.file_id, caption=caption)
-            elif kind == "sticker":
-                await bot.send_sticker(chat_id=rid, sticker=message.sticker.file_id)
-            elif kind == "animation":
-                await bot.send_animation(chat_id=rid, animation=message.animation.file_id, caption=caption)
-            elif kind == "voice":
-                await bot.send_voice(chat_id=rid, voice=message.voice.file_id, caption=caption)
-            elif kind == "audio":
-                await bot.send_audio(chat_id=rid, audio=message.audio.file_id, caption=caption)
-
-            # лог успешной отправки
-            print(f"Sent to {rid} (from {uid})")
-
-        except TelegramForbiddenError:
-            print(f"Bot blocked by {rid} — ignoring.")
-        except Exception as e:
-            print(f"Error sending to {rid}: {e}")
+    # record in the outbox, then fan out
+    payload = build_payload(message, kind, caption)
+    entry = await create_broadcasts(uid, payload)
+    # fan out in the background: the pipeline worker is free for the next update at once
+    submit_broadcast(entry)
 
-# --- admin commands ---
-@dp.message(Command(commands=["ban"]))
-async def cmd_ban(message: Message):
-    if message.from_user.id not in ADMINS:
+async def album_handler(messages: List[Message]):
+    """A whole media album: the checks of all_msg_handler once, then one sendMediaGroup fan-out."""
+    first = messages[0]
+    uid = first.from_user.id
+    if await is_banned(uid):
+        await first.answer("🚫 Вы заблокированы.")
         return
-    if not message.reply_to_message:
-        await message.reply("Ответьте командой на сообщение пользователя.")
+
+    user_doc = await ensure_user(uid)
+    await reactivate_if_needed(uid, user_doc)
+    anon_id = user_doc.get("anon_id") if user_doc else None
+
+    captions = [sanitize_text(m.caption) for m in messages if m.caption]
+    if any(len(c) > MAX_MESSAGE_LENGTH for c in captions):
+        await first.reply(f"⚠️ Сообщение слишком длинное (макс {MAX_MESSAGE_LENGTH}).")
         return
-    target_id = message.reply_to_message.from_user.id
-    await mark_banned(target_id)
-    await message.reply(f"Пользователь {target_id} заблокирован (и будет игнорироваться).")
 
-@dp.message(Command(commands=["unban"]))
-async def cmd_unban(message: Message):
-    if message.from_user.id not in ADMINS:
+    spam_text = "\n".join(captions) or None
+    verdict = spam_guard.check(uid, spam_text)
+    if verdict == SPAM_DUPLICATE:
+        await first.reply("⚠️ Нельзя.")
         return
-    if not message.reply_to_message:
-        await message.reply("Ответьте командой на сообщение пользователя.")
+    if verdict == SPAM_TOO_FAST:
+        wait = max(1, math.ceil(spam_guard.retry_in(uid)))
+        await first.reply(f"⚠️ Подожди {wait} сек перед следующим сообщением.")
         return
-    target_id = message.reply_to_message.from_user.id
-    await mark_unbanned(target_id)
-    await message.reply(f"Пользователь {target_id} разбанен.")
+
+    for message in messages:
+        error = media_size_error(message)
+        if error:
+            await message.reply(error); return
+
+    payload = build_album_payload(messages, f"<code>[{anon_id}]</code>\n")
+    if not payload["items"]:
+        return
+    spam_guard.record(uid, spam_text)
+    print(f"[TelegramID: {uid} | ChatID: {anon_id}] -> album of {len(payload['items'])}")
+
+    entry = await create_broadcasts(uid, payload)
+    submit_broadcast(entry)
+
+album_buffer = AlbumBuffer(lambda messages: spawn(album_handler(messages)), window=ALBUM_WINDOW)
 
 # ---------------- Startup helper: reassign + notify users ----------------
-async def reassign_and_notify_all():
+async def send_announce(anon_map: Dict[int, str], rid: int):
+    anon = anon_map.get(rid)
+    if not anon:
+        anon = (await ensure_user(rid)).get("anon_id")
+    with SEND_SECONDS.time():
+        return await bot.send_message(chat_id=rid, text=f"🔄 Бот перезапущен. Ваш текущий анонимный ID:\n<code>[{anon}]</code>")
+
+async def reassign_and_notify_all(entry: OutboxEntry = None):
+    """
+    Startup announce: optionally give everyone a new anon_id (one bulk write:
+    Firestore WriteBatch of up to 500 docs / one SQLite transaction), then DM
+    everyone their ID through the rate-limited fan-out engine. The announce is
+    an outbox entry, so a restart mid-way resumes it instead of starting over.
+    """
+    anon_map = None
     try:
-        recip = await get_all_recipients()
+        if entry is None:
+            recip = await get_all_recipients()
+            if REASSIGN_ANON_ON_START:
+                anon_map = {uid: generate_anon_id() for uid in recip}
+                t0 = time.monotonic()
+                with STORAGE_CALL_SECONDS.time(op="bulk_update"), span("storage.bulk_update"):
+                    await storage.bulk_update({uid: {"anon_id": anon, "last_send": 0.0, "last_message": ""}
+                                               for uid, anon in anon_map.items()})
+                for uid, anon in anon_map.items():
+                    user_cache.update(uid, {"anon_id": anon, "last_send": 0.0, "last_message": ""})
+                    anon_index.put(anon, uid)
+                cluster.publish({"type": "users_reset"})
+                print(f"Startup: reassigned {len(anon_map)} anon IDs in {time.monotonic() - t0:.2f}s")
+            entry = await create_broadcasts(0, {"kind": "announce"})
+        else:
+            # resumed (or handed over by worker 0): IDs were already reassigned
+            print(f"Startup announce: continuing {entry.id[:8]} after uid {entry.cursor}")
+        if anon_map is None:
+            anon_map = {uid: doc.get("anon_id") for uid, doc in await list_user_docs()}
     except Exception as e:
-        print("Failed to list recipients on startup:", e)
+        print("Startup announce failed to prepare:", e)
         return
 
-    print("Startup announce: will notify", len(recip), "users (delay", STARTUP_SEND_DELAY, "s)")
-    for uid in recip:
-        try:
-            if REASSIGN_ANON_ON_START:
-                new_anon = generate_anon_id()
-                await set_user_anon(uid, new_anon)
-            else:
-                doc = await ensure_user(uid)
-                new_anon = doc.get("anon_id")
-
-            try:
-                await bot.send_message(chat_id=uid, text=f"🔄 Бот перезапущен. Ваш текущий анонимный ID:\n<code>[{new_anon}]</code>")
-                print(f"Startup DM sent to {uid} (anon {new_anon})")
-            except TelegramForbiddenError:
-                print(f"Startup: bot blocked by {uid}.")
-            except Exception as e:
-                print(f"Startup: error sending to {uid}: {e}")
-
-            await asyncio.sleep(STARTUP_SEND_DELAY)
-        except Exception as e:
-            print("Startup: unexpected error for", uid, e)
+    print("Startup announce: will notify", len(recipient_index), "users")
+    await deliver_broadcast(entry, send=functools.partial(send_announce, anon_map), progress="Startup announce")
 
 # ========== AIOHTTP APP to receive webhook updates ==========
 async def handle_webhook(request):
+    with WEBHOOK_ACK_SECONDS.time():
+        return await _handle_webhook(request)
+
+async def _handle_webhook(request):
+    received = time.perf_counter()
     # validate secret token (if set)
     secret_env = WEBHOOK_SECRET_TOKEN
     if secret_env:
         header_val = request.headers.get("X-Telegram-Bot-Api-Secret-Token")
         if header_val != secret_env:
-            print("Webhook secret mismatch:", header_val)
+            webhook_log.warning("Webhook secret mismatch: %s", header_val)
             return web.Response(status=403, text="forbidden")
 
-    # DEBUG: напечатать заголовки (в логах Render увидишь что приходит)
     try:
-        print("Headers:", dict(request.headers))
-    except Exception:
-        pass
-
-    try:
-        raw = await request.text()
-        # не выводим очень длинные тела
-        print("RAW WEBHOOK BODY (trimmed):", raw[:2000])
-        data = json.loads(raw)
+        raw = await request.read()
+        data = json_loads(raw)
     except Exception as e:
-        print("Invalid JSON in webhook:", e)
+        webhook_log.warning("Invalid JSON in webhook: %s", e)
         return web.Response(status=400, text="invalid json")
 
-    # Попробуем разобрать update и передать в Dispatcher
+    # DEBUG: заголовки и тело (обрезанное) — только при WEBHOOK_LOG_LEVEL=DEBUG и с семплированием
+    if webhook_log.isEnabledFor(logging.DEBUG) and random.random() < WEBHOOK_LOG_SAMPLE:
+        webhook_log.debug("Headers: %s body: %s", dict(request.headers), raw[:2000])
+
+    return await route_update(data, raw, received)
+
+async def route_update(data: Any, raw: bytes = None, received: float = None, shed: bool = None,
+                       wait: bool = False):
+    """
+    Queue an update here or, in multi-worker mode, hand it to the worker owning its user.
+    ``shed`` (default: QUEUE_FULL_POLICY) acks and drops updates when the queue is full;
+    otherwise the answer is a 503. With ``wait`` a forwarded update is only answered once
+    its owner has handled it (an update queued here is waited for with update_pipeline.join()).
+    """
+    uid = update_uid(data)
+    # multi-worker: the user's owner handles the update (anti-spam, ordering)
+    if cluster.enabled and uid is not None and not cluster.is_local(uid):
+        if raw is None:
+            raw = json.dumps(data, ensure_ascii=False).encode("utf-8")
+        resp = await cluster.forward_update(cluster.owner(uid), raw, shed=shed, wait=wait)
+        if resp is not None:
+            return resp
+
+    return enqueue_update(data, received, uid, shed)
+
+async def handle_forwarded_update(raw: bytes, shed: bool = None, wait: bool = False):
     try:
-        update = Update(**data)
-        await dp.feed_update(bot, update)
+        data = json_loads(raw)
     except Exception as e:
-        # лог ошибки, но возвращаем 200, чтобы Telegram не пытался повторять слишком часто
-        print("Failed to process update:", e)
+        webhook_log.warning("Invalid JSON from another worker: %s", e)
+        return web.Response(status=400, text="invalid json")
+    resp = enqueue_update(data, shed=shed, wait=wait)
+    done = _handled.get(data.get("update_id")) if wait and isinstance(data, dict) else None
+    if done is not None:
+        await asyncio.shield(done)  # a polling worker confirms the update only after this
+    return resp
+
+# update_id -> trace started by the webhook, picked up by process_update
+_traces: Dict[Any, Trace] = {}
+# update_id -> future resolved by process_update (forwarded polled updates wait for it)
+_handled: Dict[Any, asyncio.Future] = {}
+
+def enqueue_update(data: Any, received: float = None, uid: int = None, shed: bool = None, wait: bool = False):
+    # ставим update в очередь и сразу отвечаем 200 — обработка идёт в воркерах
+    update_id = data.get("update_id") if isinstance(data, dict) else None
+    trace = Trace(update_id, received)
+    # one pipeline worker per user: their updates are handled in order
+    status = update_pipeline.submit(update_id, data, key=uid if uid is not None else update_uid(data))
+    if status == QUEUED and update_id is not None:
+        trace.lap("webhook")
+        _traces[update_id] = trace
+        if wait:
+            _handled[update_id] = asyncio.get_running_loop().create_future()
+    if status == DUPLICATE:
+        webhook_log.info("Duplicate update ignored: %s", data.get("update_id"))
+    elif status != QUEUED:
+        if shed is None:
+            shed = QUEUE_FULL_POLICY == "shed"
+        if shed:
+            webhook_log.warning("Update queue full, dropping update %s", data.get("update_id"))
+        else:
+            return web.Response(status=503, text="busy")
 
     return web.Response(status=200, text="ok")
 
+async def process_update(data: Dict[str, Any]):
+    # ошибки логирует пайплайн; Telegram уже получил 200.
+    # context={"bot": bot} сразу привязывает update к боту — иначе feed_update
+    # делает ещё один круг model_dump()/model_validate()
+    update_id = data.get("update_id")
+    trace = _traces.pop(update_id, None) or Trace(update_id)
+    await backends_ready()  # updates that came in during warm-up wait here
+    trace.lap("queued")
+    token = tracing.activate(trace)
+    try:
+        with span("handler"):
+            update = Update.model_validate(data, context={"bot": bot})
+            await dp.feed_update(bot, update)
+    finally:
+        tracing.deactivate(token)
+        done = _handled.pop(update_id, None)
+        if done is not None and not done.done():
+            done.set_result(None)
+        elapsed_ms = trace.elapsed * 1000
+        if elapsed_ms >= TRACE_SLOW_MS:
+            print(f"Slow update {update_id}: {elapsed_ms:.0f}ms — {trace.breakdown()}")
+
+update_pipeline = UpdatePipeline(process_update, workers=UPDATE_WORKERS, maxsize=UPDATE_QUEUE_SIZE,
+                                 dedupe_window=UPDATE_DEDUPE_WINDOW)
+UPDATE_QUEUE.set_function(update_pipeline.qsize)
+
+# ------------- polling mode (UPDATE_MODE=polling) -------------
+_poller = None
+_poll_offset = None  # everything before it is handled (only moves after a whole batch)
+
+async def poll_updates():
+    """
+    getUpdates in batches of POLL_LIMIT into the pipeline (users in parallel,
+    each user in order). The next request carries the new offset, which tells
+    Telegram the batch is done, only once the whole batch has been handled:
+    here (update_pipeline.join()) and by the workers it was forwarded to.
+    """
+    global _poll_offset
+    try:
+        await bot.delete_webhook(drop_pending_updates=False)  # getUpdates is refused while a webhook is set
+    except Exception as e:
+        print("Polling: failed to delete the webhook:", e)
+    print(f"Polling: getUpdates limit={POLL_LIMIT} timeout={POLL_TIMEOUT}s")
+    backoff = 1.0
+    while True:
+        try:
+            updates = await raw_sender.request(
+                GetUpdates(offset=_poll_offset, limit=POLL_LIMIT, timeout=POLL_TIMEOUT, allowed_updates=["message"]),
+                timeout=POLL_TIMEOUT + 10)
+            backoff = 1.0
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Polling: getUpdates failed ({e}), retrying in {backoff:.0f}s")
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, 30.0)
+            continue
+        if not updates:
+            continue
+        received = time.perf_counter()
+        chains: Dict[Any, List[Dict[str, Any]]] = {}  # per user, in order
+        for data in updates:
+            chains.setdefault(update_uid(data), []).append(data)
+        await asyncio.gather(*(submit_polled(chain, received) for chain in chains.values()))
+        await update_pipeline.join()
+        _poll_offset = updates[-1]["update_id"] + 1
+
+async def submit_polled(chain: List[Dict[str, Any]], received: float):
+    """One user's polled updates, in order: each is queued here or handled by its owner worker."""
+    for data in chain:
+        # never shed: an update is only confirmed once it has been handled
+        while (await route_update(data, received=received, shed=False, wait=True)).status == 503:
+            await asyncio.sleep(0.1)  # queue full (or owner worker busy)
+
+async def stop_polling():
+    """
+    Stop polling and confirm the batches that were handled completely, so a
+    restart does not get them again. A batch cut short by the shutdown is not
+    confirmed: Telegram hands it out again (handled at least once).
+    """
+    global _poller
+    if _poller is None:
+        return
+    _poller.cancel()
+    await asyncio.gather(_poller, return_exceptions=True)
+    _poller = None
+    await update_pipeline.stop()
+    if _poll_offset is not None:
+        try:
+            await raw_sender.request(GetUpdates(offset=_poll_offset, limit=1, timeout=0))
+        except Exception as e:
+            print("Polling: failed to confirm the last updates:", e)
+
 async def health(request):
+    if _startup_failed:
+        return web.Response(status=503, text="startup failed")
     return web.Response(text="ok")
 
+async def ready(request):
+    """Readiness: 200 once storage is up and the warm-up is done (liveness is /)."""
+    body = {"ready": _backends_ready.is_set() and _warm, "backends": _backends_ready.is_set(), "warm": _warm,
+            "webhook": _webhook_state, "phases": {k: round(v, 3) for k, v in startup_phases.items()}}
+    return web.json_response(body, status=200 if body["ready"] else 503)
+
+async def metrics(request):
+    return web.Response(body=REGISTRY.render().encode("utf-8"), headers={"Content-Type": CONTENT_TYPE})
+
 # ------------- webhook installation helper -------------
 async def ensure_webhook_set(url: str, path: str, secret: str = None, retries: int = 6):
     """
@@ -521,30 +1365,98 @@ async def ensure_webhook_set(url: str, path: str, secret: str = None, retries: i
                 print("All webhook set attempts failed.")
                 return False
 
-async def on_startup(app):
-    # try to set webhook reliably (in background)
-    if WEBHOOK_URL:
-        # run ensure_webhook_set but do not block server startup too long
+async def setup_webhook():
+    global _webhook_state
+    with startup_phase("webhook"):
         try:
             ok = await ensure_webhook_set(WEBHOOK_URL, WEBHOOK_PATH, secret=WEBHOOK_SECRET_TOKEN, retries=6)
+            _webhook_state = "set" if ok else "failed"
             if not ok:
                 print("Warning: webhook not set on startup. You may need to set it manually.")
         except Exception as e:
+            _webhook_state = "failed"
             print("Unexpected error while setting webhook:", e)
+
+def fail_startup(error: BaseException):
+    """
+    Warm-up failed: the bot cannot handle updates, so stop the process (exit
+    code 1) instead of acking webhooks that would wait forever in the pipeline.
+    """
+    global _startup_failed
+    _startup_failed = True
+    print(f"Startup failed: {error!r} — shutting down")
+    traceback.print_exception(error)
+    os.kill(os.getpid(), signal.SIGTERM)  # run_app shuts down gracefully, __main__ exits with 1
+
+async def warm_up():
+    """Everything the listener does not need to start: backends, indexes, interrupted broadcasts."""
+    global _warm
+    try:
+        await init_backends()
+
+        with startup_phase("recipients"):
+            try:
+                await load_recipient_index(warm_cache=True)
+            except Exception as e:
+                print("Failed to load recipient index on startup:", e)
+
+        # finish broadcasts interrupted by the previous shutdown
+        with startup_phase("resume_outbox"):
+            announces = await resume_outbox()
+            for stale in announces[1:]:
+                await outbox.complete(stale.id)
+    except Exception as e:
+        fail_startup(e)
+        return
+    _warm = True
+    print(f"Startup: ready {time.perf_counter() - _MODULE_STARTED:.2f}s after import started")
+
+    # startup announce if enabled (or unfinished from the previous run) — in background
+    if announces:
+        spawn(reassign_and_notify_all(announces[0]))
+    elif STARTUP_ANNOUNCE and cluster.index == 0:
+        spawn(reassign_and_notify_all())
+
+async def on_startup(app):
+    global _poller, _webhook_state
+    # the listener comes up right after this: everything slow runs in the background
+    with startup_phase("listener"):
+        update_pipeline.start()
+        await cluster.start(handle_forwarded_update, on_cluster_event)
+
+    if cluster.index != 0:
+        _webhook_state = "n/a"  # worker 0 sets the webhook (or polls) for the whole cluster
+    elif UPDATE_MODE == "polling":
+        _webhook_state = "polling"
+        _poller = asyncio.create_task(poll_updates())
+    elif WEBHOOK_URL:
+        spawn(setup_webhook())
     else:
+        _webhook_state = "unset"
         print("WEBHOOK_URL not set. Please run setWebhook manually after deploy.")
 
-    # startup announce if enabled
-    if STARTUP_ANNOUNCE:
-        # spawn as background task
-        try:
-            app.loop.create_task(reassign_and_notify_all())
-        except Exception:
-            # fallback for different event loop APIs
-            asyncio.create_task(reassign_and_notify_all())
+    spawn(warm_up())
 
 async def on_shutdown(app):
     # *не* удаляем webhook автоматически (умышленно) — это уменьшает риск сброса при быстрых рестартах
+    await stop_polling()
+    await update_pipeline.stop()
+    # albums still in their window: get them into the outbox (delivery resumes after restart)
+    await asyncio.gather(*album_buffer.flush_all(), return_exceptions=True)
+    await cluster.stop()
+    for task in list(_background_tasks):
+        task.cancel()
+    await asyncio.gather(*_background_tasks, return_exceptions=True)
+    if storage is not None:
+        await _flush_inactive(0)
+    await fanout.stop()
+    await raw_sender.close()
+    if outbox is not None:
+        await outbox.close()
+    if _recipient_watch is not None:
+        _recipient_watch.unsubscribe()
+    if storage is not None:
+        await storage.close()
     try:
         await bot.session.close()
     except Exception:
@@ -552,14 +1464,26 @@ async def on_shutdown(app):
 
 def create_app():
     app = web.Application()
-    app.add_routes([web.post(WEBHOOK_PATH, handle_webhook), web.get("/", health)])
+    app.add_routes([web.post(WEBHOOK_PATH, handle_webhook), web.get("/", health), web.get("/ready", ready),
+                    web.get("/metrics", metrics)])
     app.on_startup.append(on_startup)
     app.on_cleanup.append(on_shutdown)
     return app
 
+record_phase("import", time.perf_counter() - _MODULE_STARTED)
+
 # ========== RUN ==========
 if __name__ == "__main__":
+    if WORKERS > 1 and "WORKER_INDEX" not in os.environ:
+        from cluster import supervise
+        raise SystemExit(supervise(WORKERS, [sys.executable, os.path.abspath(__file__)]))
+    # WARNING for libraries: aiohttp's access log and aiogram's "Update ... is handled"
+    # would write two lines per update on the hot path
+    logging.basicConfig(level=logging.WARNING, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    logging.getLogger("anonbot").setLevel(logging.INFO)  # anonbot.webhook keeps WEBHOOK_LOG_LEVEL
     port = int(os.environ.get("PORT", "10000"))
     app = create_app()
-    print("Starting aiohttp on port", port)
-    web.run_app(app, host="0.0.0.0", port=port)
+    print("Starting aiohttp on port", port, f"(worker {cluster.index}/{cluster.size})" if cluster.enabled else "")
+    web.run_app(app, host="0.0.0.0", port=port, reuse_port=cluster.enabled or None)
+    if _startup_failed:
+        raise SystemExit(1)
@@ -0,0 +1,255 @@
+# cache.py
+"""In-memory indexes kept in front of the persistent storage."""
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, Optional, Tuple
+
+
+class RecipientIndex:
+    """
+    Set of users that receive broadcasts: known, not banned and not inactive
+    (inactive = the bot was blocked or the chat is gone).
+
+    Loaded once at startup and then maintained by the write paths, so building
+    a fan-out list needs no storage reads. ``recipients()`` returns a cached
+    tuple (sorted by uid) that is rebuilt only after a change.
+    """
+
+    def __init__(self):
+        # the Firestore snapshot listener calls back from its own thread
+        self._lock = threading.Lock()
+        self._known: set = set()
+        self._banned: set = set()
+        self._inactive: set = set()
+        self._snapshot: Optional[Tuple[int, ...]] = None
+        self.loaded = False
+
+    def load(self, docs: Iterable[Tuple[int, Dict[str, Any]]]):
+        known, banned, inactive = set(), set(), set()
+        for uid, doc in docs:
+            known.add(uid)
+            if doc.get("banned", False):
+                banned.add(uid)
+            if doc.get("inactive", False):
+                inactive.add(uid)
+        with self._lock:
+            self._known, self._banned, self._inactive = known, banned, inactive
+            self._snapshot = None
+            self.loaded = True
+
+    def recipients(self) -> Tuple[int, ...]:
+        snap = self._snapshot
+        if snap is None:
+            with self._lock:
+                snap = self._snapshot = tuple(sorted(self._known - self._banned - self._inactive))
+        return snap
+
+    def __len__(self):
+        return len(self.recipients())
+
+    def __contains__(self, uid: int):
+        return uid in self._known and uid not in self._banned and uid not in self._inactive
+
+    def counts(self) -> Dict[str, int]:
+        with self._lock:
+            return {"total": len(self._known), "active": len(self._known - self._banned - self._inactive),
+                    "inactive": len(self._inactive - self._banned), "banned": len(self._banned)}
+
+    # ----- write paths -----
+    def add(self, uid: int):
+        if uid not in self._known:
+            with self._lock:
+                self._known.add(uid)
+                self._snapshot = None
+
+    def remove(self, uid: int):
+        with self._lock:
+            self._known.discard(uid)
+            self._banned.discard(uid)
+            self._inactive.discard(uid)
+            self._snapshot = None
+
+    def ban(self, uid: int):
+        with self._lock:
+            self._known.add(uid)
+            self._banned.add(uid)
+            self._snapshot = None
+
+    def unban(self, uid: int):
+        if uid in self._banned:
+            with self._lock:
+                self._banned.discard(uid)
+                self._snapshot = None
+
+    def deactivate(self, uid: int):
+        if uid not in self._inactive:
+            with self._lock:
+                self._inactive.add(uid)
+                self._snapshot = None
+
+    def reactivate(self, uid: int):
+        if uid in self._inactive:
+            with self._lock:
+                self._inactive.discard(uid)
+                self._snapshot = None
+
+    def is_inactive(self, uid: int) -> bool:
+        return uid in self._inactive
+
+    def apply(self, uid: int, doc: Optional[Dict[str, Any]]):
+        """Sync one user from a storage document (None = deleted)."""
+        if doc is None:
+            self.remove(uid)
+            return
+        self.add(uid)
+        if doc.get("banned", False):
+            self.ban(uid)
+        else:
+            self.unban(uid)
+        if doc.get("inactive", False):
+            self.deactivate(uid)
+        else:
+            self.reactivate(uid)
+
+    # ----- Firestore live updates -----
+    def watch(self, collection):
+        """Keep the index fresh from a Firestore snapshot listener; returns the watch handle."""
+        def on_snapshot(col_snapshot, changes, read_time):
+            for change in changes:
+                try:
+                    uid = int(change.document.id)
+                except ValueError:
+                    continue
+                if change.type.name == "REMOVED":
+                    self.apply(uid, None)
+                else:
+                    self.apply(uid, change.document.to_dict() or {})
+        return collection.on_snapshot(on_snapshot)
+
+
+class UserCache:
+    """
+    Bounded LRU cache of user documents with a TTL.
+
+    Misses are cached too (``None`` doc), so ``is_banned`` followed by
+    ``ensure_user`` for a new user costs a single storage read. Entries are
+    shared, callers must not mutate returned dicts.
+    """
+
+    def __init__(self, maxsize: int = 10000, ttl: float = 300.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[int, Tuple[float, Optional[Dict[str, Any]]]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, uid: int) -> Tuple[bool, Optional[Dict[str, Any]]]:
+        entry = self._data.get(uid)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self._data[uid]
+            self.misses += 1
+            return False, None
+        self._data.move_to_end(uid)
+        self.hits += 1
+        return True, entry[1]
+
+    def put(self, uid: int, doc: Optional[Dict[str, Any]]):
+        self._data[uid] = (time.monotonic() + self.ttl, doc)
+        self._data.move_to_end(uid)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def update(self, uid: int, updates: Dict[str, Any]):
+        """Apply a partial update to a cached doc (a cached miss is dropped)."""
+        entry = self._data.get(uid)
+        if entry is None:
+            return
+        if entry[1] is None:
+            del self._data[uid]
+        else:
+            self._data[uid] = (entry[0], {**entry[1], **updates})
+
+    def invalidate(self, uid: int):
+        self._data.pop(uid, None)
+
+    def clear(self):
+        self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {"size": len(self._data), "hits": self.hits, "misses": self.misses,
+                "hit_ratio": self.hits / total if total else 0.0}
+
+
+class RelayIndex:
+    """
+    Fixed-size ring buffer: (recipient chat, delivered message_id) -> sender uid.
+
+    Filled by the fan-out as copies are delivered, so an admin replying to a
+    relayed copy in their own chat can be resolved to the original author.
+    Keys are packed into one int (private chat ids are positive, message ids
+    fit in 32 bits); the oldest copy is overwritten once ``maxsize`` is reached.
+    """
+
+    def __init__(self, maxsize: int = 100000):
+        self.maxsize = max(1, maxsize)
+        self._ring: list = [None] * self.maxsize
+        self._pos = 0
+        self._map: Dict[int, int] = {}
+
+    @staticmethod
+    def _key(chat_id: int, message_id: int) -> int:
+        return (chat_id << 32) | (message_id & 0xFFFFFFFF)
+
+    def add(self, chat_id: int, message_id: int, sender: int):
+        key = self._key(chat_id, message_id)
+        old = self._ring[self._pos]
+        if old is not None and old != key:
+            self._map.pop(old, None)
+        self._ring[self._pos] = key
+        self._pos = (self._pos + 1) % self.maxsize
+        self._map[key] = sender
+
+    def get(self, chat_id: int, message_id: int) -> Optional[int]:
+        return self._map.get(self._key(chat_id, message_id))
+
+    def clear(self):
+        self._ring = [None] * self.maxsize
+        self._pos = 0
+        self._map.clear()
+
+    def __len__(self):
+        return len(self._map)
+
+
+class AnonIndex:
+    """Bounded LRU map anon_id -> uid (anon ids are random, so this is a plain hash lookup)."""
+
+    def __init__(self, maxsize: int = 100000):
+        self.maxsize = maxsize
+        self._data: "OrderedDict[str, int]" = OrderedDict()
+
+    def put(self, anon_id: Optional[str], uid: int):
+        if not anon_id:
+            return
+        self._data[anon_id] = uid
+        self._data.move_to_end(anon_id)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def get(self, anon_id: str) -> Optional[int]:
+        uid = self._data.get(anon_id)
+        if uid is not None:
+            self._data.move_to_end(anon_id)
+        return uid
+
+    def clear(self):
+        self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
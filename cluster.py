@@ -0,0 +1,223 @@
+# cluster.py
+"""
+Multi-worker mode (WORKERS > 1).
+
+``supervise()`` starts WORKERS copies of the bot; they all listen on PORT
+with SO_REUSEPORT, so the kernel spreads webhook requests across them. Every
+user belongs to one worker (``uid % WORKERS``):
+
+  * a webhook update from a user owned by another worker is forwarded to
+    that worker, so anti-spam state and per-user ordering stay in one place
+    (a polled update is only answered once the owner has handled it);
+  * a broadcast is split into one outbox entry per recipient shard and each
+    worker delivers its own shard;
+  * user changes (ban, anon_id, inactive) go to the shared storage first and
+    are then published to the other workers, which drop their cached copies.
+
+Workers talk HTTP over Unix sockets in ``CLUSTER_DIR``. Events are delivered
+in order per peer and best-effort: a lost invalidation only means a cached
+doc lives until USER_CACHE_TTL, a lost broadcast event is picked up from the
+outbox when that worker restarts.
+"""
+import asyncio
+import json
+import os
+import signal
+import subprocess
+import sys
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+import aiohttp
+from aiohttp import web
+
+EventHandler = Callable[[Dict[str, Any]], Awaitable[None]]
+UpdateHandler = Callable[[bytes, Optional[bool], bool], Awaitable[web.Response]]
+
+
+def update_uid(data: Any) -> Optional[int]:
+    """Telegram user the update comes from (message, edited_message, callback_query, ...)."""
+    if not isinstance(data, dict):
+        return None
+    for key, value in data.items():
+        if key != "update_id" and isinstance(value, dict):
+            sender = value.get("from")
+            if isinstance(sender, dict) and "id" in sender:
+                return sender["id"]
+    return None
+
+
+class Cluster:
+    def __init__(self, index: int = 0, size: int = 1, socket_dir: str = "/tmp/anonbot-cluster"):
+        self.index = index
+        self.size = max(1, size)
+        self.socket_dir = socket_dir
+        self._runner: Optional[web.AppRunner] = None
+        self._sessions: Dict[int, aiohttp.ClientSession] = {}
+        self._queues: Dict[int, asyncio.Queue] = {}
+        self._senders: List[asyncio.Task] = []
+        self.forwarded = 0
+        self.events_sent = 0
+        self.events_failed = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.size > 1
+
+    def owner(self, uid: int) -> int:
+        return uid % self.size
+
+    def is_local(self, uid: int) -> bool:
+        return self.owner(uid) == self.index
+
+    @property
+    def peers(self) -> List[int]:
+        return [i for i in range(self.size) if i != self.index]
+
+    def socket_path(self, worker: int) -> str:
+        return os.path.join(self.socket_dir, f"worker-{worker}.sock")
+
+    # ----- lifecycle -----
+    async def start(self, on_update: UpdateHandler, on_event: EventHandler):
+        if not self.enabled:
+            return
+
+        async def handle_update(request):
+            shed = request.headers.get("X-Queue-Full")  # sender's choice for a full queue
+            wait = request.headers.get("X-Reply-When") == "handled"
+            return await on_update(await request.read(), None if shed is None else shed == "shed", wait)
+
+        async def handle_event(request):
+            await on_event(await request.json())
+            return web.Response(text="ok")
+
+        os.makedirs(self.socket_dir, exist_ok=True)
+        path = self.socket_path(self.index)
+        if os.path.exists(path):
+            os.unlink(path)
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.add_routes([web.post("/update", handle_update), web.post("/event", handle_event)])
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.UnixSite(self._runner, path).start()
+        for peer in self.peers:
+            self._sessions[peer] = aiohttp.ClientSession(
+                connector=aiohttp.UnixConnector(path=self.socket_path(peer)),
+                timeout=aiohttp.ClientTimeout(total=10))
+            self._queues[peer] = asyncio.Queue()
+            self._senders.append(asyncio.create_task(self._sender(peer)))
+        print(f"Cluster: worker {self.index}/{self.size} listening on {path}")
+
+    async def stop(self):
+        for task in self._senders:
+            task.cancel()
+        await asyncio.gather(*self._senders, return_exceptions=True)
+        self._senders = []
+        for session in self._sessions.values():
+            await session.close()
+        self._sessions.clear()
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    # ----- updates -----
+    async def forward_update(self, worker: int, raw: bytes, shed: Optional[bool] = None,
+                             wait: bool = False) -> Optional[web.Response]:
+        """
+        Hand a raw webhook body to its owner; None if the owner is unreachable.
+        ``shed`` overrides the owner's QUEUE_FULL_POLICY (False: answer 503 instead of dropping).
+        With ``wait`` the owner answers once the update has been handled, not when it is queued.
+        """
+        session = self._sessions.get(worker)
+        if session is None:
+            return None
+        headers = {"Content-Type": "application/json"}
+        if shed is not None:
+            headers["X-Queue-Full"] = "shed" if shed else "503"
+        timeout = session.timeout
+        if wait:
+            headers["X-Reply-When"] = "handled"
+            timeout = aiohttp.ClientTimeout(total=None, sock_connect=10)  # waits behind the owner's queue
+        try:
+            async with session.post("http://worker/update", data=raw, headers=headers, timeout=timeout) as r:
+                text = await r.text()
+            self.forwarded += 1
+            return web.Response(status=r.status, text=text)
+        except (aiohttp.ClientError, asyncio.TimeoutError, OSError) as e:
+            print(f"Cluster: worker {worker} unreachable ({e}), handling the update locally")
+            return None
+
+    # ----- events -----
+    def send(self, worker: int, event: Dict[str, Any]):
+        queue = self._queues.get(worker)
+        if queue is not None:
+            queue.put_nowait(event)
+
+    def publish(self, event: Dict[str, Any]):
+        """Send ``event`` to every other worker (in order per peer, does not wait)."""
+        for peer in self._queues:
+            self.send(peer, event)
+
+    async def _sender(self, peer: int):
+        session = self._sessions[peer]
+        queue = self._queues[peer]
+        while True:
+            event = await queue.get()
+            body = json.dumps(event, ensure_ascii=False)
+            for attempt in range(5):
+                try:
+                    async with session.post("http://worker/event", data=body,
+                                            headers={"Content-Type": "application/json"}) as r:
+                        r.raise_for_status()
+                    self.events_sent += 1
+                    break
+                except (aiohttp.ClientError, asyncio.TimeoutError, OSError) as e:
+                    # peer still starting or restarting
+                    if attempt == 4:
+                        self.events_failed += 1
+                        print(f"Cluster: dropping {event.get('type')} event for worker {peer}: {e}")
+                    else:
+                        await asyncio.sleep(0.5 * 2 ** attempt)
+
+
+# ---------------------------------------------------------------- supervisor
+def supervise(size: int, argv: List[str]):
+    """Run ``size`` worker processes (WORKER_INDEX=0..size-1), restart the ones that die."""
+    procs: Dict[int, subprocess.Popen] = {}
+    stopping = False
+
+    def start_worker(i: int):
+        env = dict(os.environ, WORKERS=str(size), WORKER_INDEX=str(i))
+        procs[i] = subprocess.Popen(argv, env=env)
+        print(f"Cluster: started worker {i} (pid {procs[i].pid})")
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for p in procs.values():
+            if p.poll() is None:
+                p.send_signal(signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for i in range(size):
+        start_worker(i)
+    while not stopping:
+        time.sleep(0.5)
+        for i, p in list(procs.items()):
+            if p.poll() is not None and not stopping:
+                print(f"Cluster: worker {i} exited with {p.returncode}, restarting")
+                time.sleep(1.0)
+                start_worker(i)
+    deadline = time.monotonic() + 30
+    for p in procs.values():
+        try:
+            p.wait(timeout=max(0.1, deadline - time.monotonic()))
+        except subprocess.TimeoutExpired:
+            p.kill()
+    return 0
+
+
+if __name__ == "__main__":
+    n = int(os.getenv("WORKERS", "2"))
+    sys.exit(supervise(n, [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "bot.py")]))
@@ -0,0 +1,68 @@
+# digest.py
+"""
+Adaptive coalescing of text relays.
+
+Every relay costs one send per recipient. When the fan-out backlog grows past
+``high`` pending sends (inbound rate x users > the Bot API budget), new text
+relays are held back and merged into digests of up to ``limit`` characters,
+one send per recipient for the whole digest; each part keeps its
+``<code>[anon_id]</code>`` header. Below ``low`` the bot goes back to one
+message per relay. Media are never merged.
+"""
+import time
+from typing import Dict, Hashable, List, Optional, Tuple
+
+from outbox import OutboxEntry
+
+SEPARATOR = "\n\n"
+
+
+class Coalescer:
+    def __init__(self, high: int, low: Optional[int] = None, limit: int = 4096, max_delay: float = 30.0):
+        self.high = high
+        self.low = high // 2 if low is None else low
+        self.limit = limit
+        self.max_delay = max_delay
+        self.active = False
+        # key (recipient shard) -> (first buffered at, entries, text length)
+        self._buffers: Dict[Hashable, Tuple[float, List[OutboxEntry], int]] = {}
+
+    @property
+    def enabled(self) -> bool:
+        return self.high > 0
+
+    @property
+    def pending(self) -> int:
+        return sum(len(b[1]) for b in self._buffers.values())
+
+    def update(self, backlog: int) -> bool:
+        """Switch on above ``high``, off below ``low``; returns the current mode."""
+        if not self.enabled:
+            return False
+        if not self.active and backlog > self.high:
+            self.active = True
+            print(f"Digest mode on: {backlog} sends queued")
+        elif self.active and backlog < self.low:
+            self.active = False
+            print(f"Digest mode off: {backlog} sends queued")
+        return self.active
+
+    def add(self, key: Hashable, entry: OutboxEntry) -> Optional[List[OutboxEntry]]:
+        """Buffer a text relay; returns a full batch when ``entry`` does not fit into the current one."""
+        size = len(entry.payload["text"])
+        started, entries, length = self._buffers.get(key, (time.monotonic(), [], 0))
+        if entries and length + len(SEPARATOR) + size > self.limit:
+            self._buffers[key] = (time.monotonic(), [entry], size)
+            return entries
+        self._buffers[key] = (started, entries + [entry], length + (len(SEPARATOR) if entries else 0) + size)
+        return None
+
+    def take(self, force: bool = False) -> List[Tuple[Hashable, List[OutboxEntry]]]:
+        """Batches due for delivery: all of them with ``force``, otherwise those older than ``max_delay``."""
+        now = time.monotonic()
+        due = [k for k, b in self._buffers.items() if force or now - b[0] >= self.max_delay]
+        return [(k, self._buffers.pop(k)[1]) for k in due]
+
+
+def digest_text(parts: List[dict], exclude: Optional[int] = None) -> str:
+    return SEPARATOR.join(p["text"] for p in parts if p["sender"] != exclude)
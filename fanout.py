@@ -0,0 +1,373 @@
+# fanout.py
+"""
+Broadcast fan-out engine.
+
+One broadcast = one message delivered to many chats. Sends are executed by a
+bounded pool of workers and throttled by token buckets: a global one (Telegram
+allows ~30 msg/s per bot) and one per chat (~1 msg/s). ``TelegramRetryAfter``
+pauses the whole engine instead of dropping the message, transient network /
+server errors are retried with backoff.
+
+Two lanes share the global budget:
+  * interactive - replies, welcome messages, admin acks: every Bot API call
+    made outside the fan-out workers (``InteractiveLane`` session middleware).
+    They go out at once and borrow from the global bucket, so broadcast sends
+    absorb the debt instead of the reply waiting behind them.
+  * broadcast - round-robin across originating senders (one send per sender
+    per turn, a sender's own broadcasts in FIFO order), so a chatty user gets
+    the same share of the rate as everyone else, not one share per message.
+
+Concurrent broadcasts walk the same recipient list, so the next recipient of
+one often is a chat another broadcast has just used. Such a recipient is set
+aside (up to PARK_LIMIT per broadcast) until its chat may take a message
+again, and the turn goes to a recipient that can be served now: a worker
+only takes a global token for a send that can go out at once.
+"""
+import asyncio
+import contextvars
+import heapq
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Dict, Hashable, Iterable, Optional
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+
+from aiogram.exceptions import (
+    TelegramForbiddenError,
+    TelegramNetworkError,
+    TelegramRetryAfter,
+    TelegramServerError,
+)
+
+# errors worth another attempt (everything else is final for the recipient)
+TRANSIENT_ERRORS = (TelegramNetworkError, TelegramServerError, asyncio.TimeoutError, ConnectionError)
+
+
+class TokenBucket:
+    """Reservation-style token bucket: ``reserve()`` returns how long to wait."""
+
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = float(rate)
+        self.capacity = float(capacity) if capacity is not None else max(1.0, self.rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def reserve(self, now: Optional[float] = None) -> float:
+        now = time.monotonic() if now is None else now
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1.0
+        if self.tokens >= 0:
+            return 0.0
+        return -self.tokens / self.rate
+
+    def wait(self, now: float) -> float:
+        """Seconds until a token is available (reserves nothing)."""
+        tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        return 0.0 if tokens >= 1.0 else (1.0 - tokens) / self.rate
+
+    def idle(self, now: float) -> bool:
+        """True when the bucket would be full again (safe to forget)."""
+        return self.tokens + (now - self.updated) * self.rate >= self.capacity
+
+    async def acquire(self):
+        delay = self.reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+class BroadcastStats:
+    __slots__ = ("label", "total", "sent", "forbidden", "failed", "retries", "started", "finished")
+
+    def __init__(self, label: str = ""):
+        self.label = label
+        self.total = 0
+        self.sent = 0
+        self.forbidden = 0
+        self.failed = 0
+        self.retries = 0
+        self.started = time.monotonic()
+        self.finished: Optional[float] = None
+
+    def record(self, status: str):
+        self.total += 1
+        if status == "sent":
+            self.sent += 1
+        elif status == "forbidden":
+            self.forbidden += 1
+        else:
+            self.failed += 1
+
+    @property
+    def elapsed(self) -> float:
+        return (self.finished or time.monotonic()) - self.started
+
+    @property
+    def throughput(self) -> float:
+        return self.total / self.elapsed if self.elapsed > 0 else 0.0
+
+    def summary(self) -> str:
+        return (f"broadcast {self.label or '-'}: {self.sent}/{self.total} sent, {self.forbidden} forbidden, "
+                f"{self.failed} failed, {self.retries} retries in {self.elapsed:.2f}s ({self.throughput:.1f} msg/s)")
+
+
+SendFn = Callable[[int], Awaitable[Any]]
+ResultFn = Callable[[int, str, Any], None]
+
+
+# recipients a broadcast may set aside while their chat is throttled
+PARK_LIMIT = 64
+
+# True inside fan-out workers (their Bot API calls are broadcast traffic)
+_in_fanout: contextvars.ContextVar = contextvars.ContextVar("in_fanout", default=False)
+
+
+class _Job:
+    __slots__ = ("owner", "it", "send", "on_result", "stats", "done", "pending", "exhausted", "size",
+                 "drained", "parked")
+
+    def __init__(self, owner: Hashable, recipients: Iterable[int], send: SendFn, on_result: Optional[ResultFn],
+                 label: str, size: int = 0):
+        self.owner = owner
+        self.size = size  # expected number of recipients, 0 if unknown
+        self.it = iter(recipients)
+        self.send = send
+        self.on_result = on_result
+        self.stats = BroadcastStats(label)
+        self.done = asyncio.get_running_loop().create_future()
+        self.pending = 0
+        self.exhausted = False  # no recipient left to hand out
+        self.drained = False  # iterator used up (parked ones may remain)
+        self.parked: list = []  # heap of (chat ready at, rid)
+
+    def maybe_finish(self):
+        if self.exhausted and self.pending == 0 and not self.done.done():
+            self.stats.finished = time.monotonic()
+            self.done.set_result(self.stats)
+
+
+class FanoutEngine:
+    def __init__(self, concurrency: int = 20, global_rate: float = 30.0, per_chat_rate: float = 1.0,
+                 max_retries: int = 3, on_result: Optional[ResultFn] = None):
+        self.concurrency = max(1, concurrency)
+        self.max_retries = max_retries
+        self.on_result = on_result
+        self._global = TokenBucket(global_rate)
+        self._per_chat_rate = per_chat_rate
+        self._chats: Dict[int, TokenBucket] = {}
+        self._paused_until = 0.0
+        self._queues: Dict[Hashable, deque] = {}  # owner -> its broadcasts, FIFO
+        self._turns: deque = deque()  # owners with work, round-robin
+        self._wakeup: Optional[asyncio.Event] = None
+        self._workers = []
+
+    # ----- lifecycle -----
+    def start(self):
+        if self._workers:
+            return
+        self._wakeup = asyncio.Event()
+        # workers outlive the broadcast that started them: don't let them inherit its context
+        self._workers = [asyncio.create_task(self._worker(), context=contextvars.Context())
+                         for _ in range(self.concurrency)]
+
+    async def stop(self):
+        for w in self._workers:
+            w.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        # unfinished broadcasts are abandoned (the outbox resumes them)
+        for jobs in self._queues.values():
+            for job in jobs:
+                if not job.done.done():
+                    job.done.cancel()
+        self._queues.clear()
+        self._turns.clear()
+
+    @property
+    def active_broadcasts(self) -> int:
+        return sum(len(jobs) for jobs in self._queues.values())
+
+    @property
+    def active_senders(self) -> int:
+        return len(self._turns)
+
+    @property
+    def backlog(self) -> int:
+        """Sends still ahead of the queued broadcasts (from their ``size`` hints)."""
+        return sum(max(0, job.size - job.stats.total) for jobs in self._queues.values() for job in jobs)
+
+    # ----- public API -----
+    async def broadcast(self, recipients: Iterable[int], send: SendFn, label: str = "",
+                        on_result: Optional[ResultFn] = None, owner: Hashable = None,
+                        size: int = 0) -> BroadcastStats:
+        """
+        Deliver ``send(rid)`` to every recipient; resolves when all of them are done.
+        Broadcasts of the same ``owner`` (originating sender) run one after another.
+        ``size`` (expected recipient count) only feeds ``backlog``.
+        """
+        self.start()
+        job = _Job(owner, recipients, send, on_result, label, size)
+        jobs = self._queues.get(owner)
+        if jobs is None:
+            jobs = self._queues[owner] = deque()
+            self._turns.append(owner)
+        jobs.append(job)
+        self._wakeup.set()
+        return await job.done
+
+    def pause(self, seconds: float):
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    async def interactive(self, chat_id: Optional[int] = None):
+        """
+        Slot for an interactive send: ahead of every broadcast. It takes its global
+        and per-chat tokens without waiting for them (broadcast sends absorb the
+        debt), only a flood-control pause holds it back.
+        """
+        now = time.monotonic()
+        self._global.reserve(now)
+        if chat_id is not None:
+            self._chat_bucket(chat_id, now).reserve(now)
+        if self._paused_until > now:
+            await asyncio.sleep(self._paused_until - now)
+
+    # ----- internals -----
+    def _take(self, job: _Job, now: float) -> Optional[int]:
+        """Next recipient of ``job`` whose chat can take a message now, parking the others."""
+        parked = job.parked
+        while parked and parked[0][0] <= now:
+            _, rid = heapq.heappop(parked)
+            delay = self._chat_bucket(rid, now).wait(now)
+            if delay <= 0:
+                return rid
+            heapq.heappush(parked, (now + delay, rid))  # an interactive send took the slot
+        while not job.drained and len(parked) < PARK_LIMIT:
+            rid = next(job.it, None)
+            if rid is None:
+                job.drained = True
+                break
+            delay = self._chat_bucket(rid, now).wait(now)
+            if delay <= 0:
+                return rid
+            heapq.heappush(parked, (now + delay, rid))
+        return None
+
+    def _next(self, now: float):
+        """(job, rid) to send now; else the time the next parked chat frees up, or None if idle."""
+        earliest = None
+        blocked = 0
+        while self._turns and blocked < len(self._turns):
+            owner = self._turns[0]
+            jobs = self._queues[owner]
+            job = jobs[0]
+            rid = self._take(job, now)
+            if rid is not None:
+                # one send per sender per turn
+                self._turns.rotate(-1)
+                self._chat_bucket(rid, now).reserve(now)
+                job.pending += 1
+                return job, rid
+            if job.drained and not job.parked:
+                jobs.popleft()
+                job.exhausted = True
+                job.maybe_finish()
+                if not jobs:
+                    del self._queues[owner]
+                    self._turns.popleft()
+                continue
+            # every candidate of this sender waits for its chat
+            ready_at = job.parked[0][0]
+            earliest = ready_at if earliest is None else min(earliest, ready_at)
+            blocked += 1
+            self._turns.rotate(-1)
+        return earliest
+
+    async def _worker(self):
+        _in_fanout.set(True)
+        while True:
+            now = time.monotonic()
+            item = self._next(now)
+            if not isinstance(item, tuple):
+                self._wakeup.clear()
+                try:
+                    # idle: until a broadcast comes in; blocked: until the first parked chat frees up
+                    await asyncio.wait_for(self._wakeup.wait(), None if item is None else item - now)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            job, rid = item
+            try:
+                await self._deliver(job, rid)
+            except Exception as e:
+                print(f"fanout: unexpected error for {rid}: {e}")
+            finally:
+                job.pending -= 1
+                job.maybe_finish()
+
+    def _chat_bucket(self, rid: int, now: float) -> TokenBucket:
+        bucket = self._chats.get(rid)
+        if bucket is None:
+            if len(self._chats) > 10000:
+                self._chats = {k: b for k, b in self._chats.items() if not b.idle(now)}
+            bucket = self._chats[rid] = TokenBucket(self._per_chat_rate, 1.0)
+        return bucket
+
+    async def _throttle(self, rid: int, chat: bool = True):
+        """Wait for a flood pause and the global token (and the chat's, unless ``_next`` took it)."""
+        now = time.monotonic()
+        if self._paused_until > now:
+            await asyncio.sleep(self._paused_until - now)
+        delay = self._global.reserve()
+        if chat:
+            delay = max(delay, self._chat_bucket(rid, now).reserve())
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def _deliver(self, job: _Job, rid: int):
+        attempt = 0
+        retry = False
+        while True:
+            await self._throttle(rid, chat=retry)
+            retry = True
+            try:
+                result = await job.send(rid)
+                status = "sent"
+            except TelegramRetryAfter as e:
+                print(f"fanout: flood control, pausing {e.retry_after}s")
+                self.pause(e.retry_after)
+                job.stats.retries += 1
+                continue
+            except TelegramForbiddenError as e:
+                status, result = "forbidden", e
+            except TRANSIENT_ERRORS as e:
+                attempt += 1
+                if attempt <= self.max_retries:
+                    job.stats.retries += 1
+                    await asyncio.sleep(min(0.5 * 2 ** attempt, 10.0))
+                    continue
+                status, result = "error", e
+            except Exception as e:
+                status, result = "error", e
+            job.stats.record(status)
+            for cb in (job.on_result, self.on_result):
+                if cb is not None:
+                    cb(rid, status, result)
+            return
+
+
+class InteractiveLane(BaseRequestMiddleware):
+    """
+    Bot session middleware: API calls made outside the fan-out workers
+    (replies, /start, admin acks, setWebhook) take the engine's interactive lane.
+    """
+
+    def __init__(self, engine: FanoutEngine):
+        self.engine = engine
+
+    async def __call__(self, make_request, bot, method):
+        if not _in_fanout.get():
+            chat_id = getattr(method, "chat_id", None)
+            await self.engine.interactive(chat_id if isinstance(chat_id, int) else None)
+        return await make_request(bot, method)
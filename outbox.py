@@ -0,0 +1,183 @@
+# outbox.py
+"""
+Durable broadcast outbox.
+
+Every broadcast is written here before the fan-out starts, together with a
+delivery cursor: recipients are delivered in ascending uid order and the
+cursor is the highest uid below which every recipient has been handled. On
+restart unfinished broadcasts resume after their cursor, so delivery is
+at-least-once and at most the few sends that were in flight get repeated.
+Finished broadcasts are deleted (the outbox only holds work in progress).
+"""
+import asyncio
+import concurrent.futures
+import functools
+import json
+import sqlite3
+import time
+import uuid
+from collections import deque
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional
+
+
+@dataclass
+class OutboxEntry:
+    id: str
+    sender: int
+    payload: Dict[str, Any]
+    cursor: int = 0
+    created_at: float = 0.0
+
+
+class DeliveryCursor:
+    """
+    Tracks the contiguous prefix of handled recipients. ``issue`` must be
+    called in delivery (ascending uid) order; ``done`` in any order.
+    """
+
+    def __init__(self, start: int = 0):
+        self.cursor = start
+        self._issued: deque = deque()
+        self._done: set = set()
+
+    def issue(self, rid: int):
+        self._issued.append(rid)
+
+    def done(self, rid: int):
+        self._done.add(rid)
+        while self._issued and self._issued[0] in self._done:
+            self.cursor = self._issued.popleft()
+            self._done.discard(self.cursor)
+
+
+class Outbox:
+    name = "none"
+
+    def __init__(self, executor: Optional[concurrent.futures.Executor] = None):
+        self._executor = executor
+
+    async def _run(self, fn, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(fn, *args, **kwargs))
+
+    @staticmethod
+    def new_entry(sender: int, payload: Dict[str, Any]) -> OutboxEntry:
+        return OutboxEntry(id=uuid.uuid4().hex, sender=sender, payload=payload, cursor=0, created_at=time.time())
+
+    async def create(self, sender: int, payload: Dict[str, Any]) -> OutboxEntry:
+        return self.new_entry(sender, payload)
+
+    async def advance(self, entry_id: str, cursor: int):
+        pass
+
+    async def complete(self, entry_id: str):
+        pass
+
+    async def pending(self) -> List[OutboxEntry]:
+        return []
+
+    async def close(self):
+        pass
+
+
+class SqliteOutbox(Outbox):
+    name = "sqlite"
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id         TEXT PRIMARY KEY,
+            sender     INTEGER NOT NULL,
+            payload    TEXT NOT NULL,
+            cursor     INTEGER NOT NULL DEFAULT 0,
+            created_at REAL NOT NULL
+        );
+    """
+
+    def __init__(self, path: str):
+        super().__init__(concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="outbox"))
+        self.path = path
+        self._conn: Optional[sqlite3.Connection] = None
+
+    def conn(self) -> sqlite3.Connection:
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(self.SCHEMA)
+            self._conn = conn
+        return self._conn
+
+    def _create_sync(self, entry: OutboxEntry):
+        self.conn().execute("INSERT INTO broadcasts (id, sender, payload, cursor, created_at) VALUES (?, ?, ?, ?, ?)",
+                            (entry.id, entry.sender, json.dumps(entry.payload, ensure_ascii=False),
+                             entry.cursor, entry.created_at))
+
+    async def create(self, sender: int, payload: Dict[str, Any]) -> OutboxEntry:
+        entry = self.new_entry(sender, payload)
+        await self._run(self._create_sync, entry)
+        return entry
+
+    def _advance_sync(self, entry_id: str, cursor: int):
+        self.conn().execute("UPDATE broadcasts SET cursor = ? WHERE id = ? AND cursor < ?", (cursor, entry_id, cursor))
+
+    async def advance(self, entry_id: str, cursor: int):
+        await self._run(self._advance_sync, entry_id, cursor)
+
+    def _complete_sync(self, entry_id: str):
+        conn = self.conn()
+        conn.execute("DELETE FROM broadcasts WHERE id = ?", (entry_id,))
+        if conn.execute("SELECT 1 FROM broadcasts LIMIT 1").fetchone() is None:
+            # nothing in flight: shrink the WAL back to zero
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    async def complete(self, entry_id: str):
+        await self._run(self._complete_sync, entry_id)
+
+    def _pending_sync(self) -> List[OutboxEntry]:
+        rows = self.conn().execute(
+            "SELECT id, sender, payload, cursor, created_at FROM broadcasts ORDER BY created_at").fetchall()
+        return [OutboxEntry(r[0], r[1], json.loads(r[2]), r[3], r[4]) for r in rows]
+
+    async def pending(self) -> List[OutboxEntry]:
+        return await self._run(self._pending_sync)
+
+    async def close(self):
+        def _close():
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+        await self._run(_close)
+
+
+class FirestoreOutbox(Outbox):
+    """One document per unfinished broadcast in ``anon_bot_outbox``."""
+    name = "firestore"
+
+    def __init__(self, collection, executor: Optional[concurrent.futures.Executor] = None):
+        super().__init__(executor)
+        self.collection = collection
+
+    async def create(self, sender: int, payload: Dict[str, Any]) -> OutboxEntry:
+        entry = self.new_entry(sender, payload)
+        data = {"sender": sender, "payload": payload, "cursor": 0, "created_at": entry.created_at}
+        await self._run(self.collection.document(entry.id).set, data)
+        return entry
+
+    async def advance(self, entry_id: str, cursor: int):
+        await self._run(self.collection.document(entry_id).update, {"cursor": cursor})
+
+    async def complete(self, entry_id: str):
+        await self._run(self.collection.document(entry_id).delete)
+
+    def _pending_sync(self) -> List[OutboxEntry]:
+        out = []
+        for d in self.collection.stream():
+            dd = d.to_dict() or {}
+            out.append(OutboxEntry(d.id, int(dd.get("sender", 0)), dd.get("payload") or {},
+                                   int(dd.get("cursor", 0)), float(dd.get("created_at", 0.0))))
+        out.sort(key=lambda e: e.created_at)
+        return out
+
+    async def pending(self) -> List[OutboxEntry]:
+        return await self._run(self._pending_sync)
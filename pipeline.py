@@ -0,0 +1,108 @@
+# pipeline.py
+"""
+In-process update pipeline: the webhook only enqueues, a pool of workers
+feeds updates to the dispatcher. Telegram gets its 200 immediately, so a slow
+broadcast can no longer time out the webhook request (which made Telegram
+redeliver the update and the bot broadcast it twice).
+
+Every worker has its own queue and updates with a ``key`` (the sending user)
+always go to the same worker, so one user's updates are handled in order
+while different users are handled concurrently. Keyless updates go to the
+shortest queue.
+"""
+import asyncio
+from collections import deque
+from typing import Any, Awaitable, Callable, List, Optional
+
+QUEUED = "queued"
+DUPLICATE = "duplicate"
+FULL = "full"
+
+
+class UpdateDeduper:
+    """Remembers the last ``window`` update ids (sliding window)."""
+
+    def __init__(self, window: int = 10000):
+        self.window = window
+        self._order: deque = deque()
+        self._seen: set = set()
+
+    def seen(self, update_id: int) -> bool:
+        return update_id in self._seen
+
+    def add(self, update_id: int):
+        self._seen.add(update_id)
+        self._order.append(update_id)
+        if len(self._order) > self.window:
+            self._seen.discard(self._order.popleft())
+
+
+class UpdatePipeline:
+    def __init__(self, handler: Callable[[Any], Awaitable[Any]], workers: int = 8,
+                 maxsize: int = 1000, dedupe_window: int = 10000):
+        self.handler = handler
+        self.workers = max(1, workers)
+        self.maxsize = maxsize
+        self.dedupe = UpdateDeduper(dedupe_window)
+        self._queues: List[asyncio.Queue] = []
+        self._tasks = []
+        self.processed = 0
+        self.failed = 0
+        self.dropped = 0
+        self.duplicates = 0
+
+    def start(self):
+        if self._tasks:
+            return
+        self._queues = [asyncio.Queue() for _ in range(self.workers)]
+        self._tasks = [asyncio.create_task(self._worker(q)) for q in self._queues]
+
+    async def stop(self, timeout: float = 10.0):
+        """Let the workers drain what is queued (up to ``timeout``), then cancel them."""
+        if not self._tasks:
+            return
+        try:
+            await asyncio.wait_for(self.join(), timeout)
+        except asyncio.TimeoutError:
+            print(f"pipeline: {self.qsize()} updates left unprocessed on shutdown")
+        for t in self._tasks:
+            t.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def join(self):
+        """Wait until everything submitted so far has been handled."""
+        for q in self._queues:
+            await q.join()
+
+    def qsize(self) -> int:
+        return sum(q.qsize() for q in self._queues)
+
+    def submit(self, update_id: Optional[int], item: Any, key: Optional[int] = None) -> str:
+        """Non-blocking enqueue: QUEUED, DUPLICATE (already seen) or FULL (not accepted)."""
+        if update_id is not None and self.dedupe.seen(update_id):
+            self.duplicates += 1
+            return DUPLICATE
+        if self.qsize() >= self.maxsize:
+            self.dropped += 1
+            return FULL
+        if key is not None:
+            queue = self._queues[key % self.workers]
+        else:
+            queue = min(self._queues, key=asyncio.Queue.qsize)
+        queue.put_nowait(item)
+        if update_id is not None:
+            self.dedupe.add(update_id)
+        return QUEUED
+
+    async def _worker(self, queue: asyncio.Queue):
+        while True:
+            item = await queue.get()
+            try:
+                await self.handler(item)
+                self.processed += 1
+            except Exception as e:
+                self.failed += 1
+                print("Failed to process update:", e)
+            finally:
+                queue.task_done()
@@ -0,0 +1,141 @@
+# sender.py
+"""
+Fast path for broadcast sends.
+
+``bot.send_*`` builds, validates and serializes a new aiogram method object
+for every recipient and parses the full ``Message`` out of every answer,
+although only ``chat_id`` changes within a broadcast. ``RawSender.prepare``
+serializes the method once (same encoding as aiogram's form data) into a body
+template; ``send`` splices in ``chat_id``, posts it over a keep-alive
+connection pool and returns a bare ``SentMessage``. ``request`` makes any
+other call the same way and returns the raw JSON result (polling feeds
+getUpdates results to the pipeline as plain dicts).
+
+Error answers go through aiogram's own ``check_response``, so callers see the
+same ``TelegramRetryAfter`` / ``TelegramForbiddenError`` / ... as before, and
+transport failures become ``TelegramNetworkError`` like in ``AiohttpSession``.
+"""
+import asyncio
+import json
+import ssl
+from typing import Any, List, Optional, Union
+from urllib.parse import urlencode
+
+import aiohttp
+import certifi
+from aiogram import Bot
+from aiogram.exceptions import TelegramAPIError, TelegramNetworkError
+from aiogram.methods.base import TelegramMethod
+
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
+
+class SentMessage:
+    """What a broadcast needs from a delivered message."""
+    __slots__ = ("message_id", "chat_id")
+
+    def __init__(self, message_id: int, chat_id: int):
+        self.message_id = message_id
+        self.chat_id = chat_id
+
+    def __repr__(self):
+        return f"SentMessage(message_id={self.message_id}, chat_id={self.chat_id})"
+
+
+class PreparedSend:
+    __slots__ = ("method", "url", "_rest")
+
+    def __init__(self, method: TelegramMethod, url: str, rest: bytes):
+        self.method = method  # kept for aiogram's error mapping
+        self.url = url
+        self._rest = rest
+
+    def body(self, chat_id: int) -> bytes:
+        return b"chat_id=%d%s" % (chat_id, self._rest)
+
+
+class RawSender:
+    CONTENT_TYPE = "application/x-www-form-urlencoded"
+
+    def __init__(self, bot: Bot, pool_size: int = 100, timeout: float = 30.0):
+        self.bot = bot
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.pool_size, limit_per_host=self.pool_size, keepalive_timeout=60,
+                ttl_dns_cache=3600, ssl=ssl.create_default_context(cafile=certifi.where()))
+            self._session = aiohttp.ClientSession(connector=connector,
+                                                  timeout=aiohttp.ClientTimeout(total=self.timeout))
+        return self._session
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    def _encode(self, method: TelegramMethod, skip: str = None) -> bytes:
+        session = self.bot.session
+        form = {}
+        for key, value in method.model_dump(warnings=False).items():
+            if key == skip:
+                continue
+            value = session.prepare_value(value, bot=self.bot, files={})
+            if value:
+                form[key] = value
+        return urlencode(form).encode("ascii")
+
+    def _url(self, method: TelegramMethod) -> str:
+        return self.bot.session.api.api_url(token=self.bot.token, method=method.__api_method__)
+
+    def prepare(self, method: TelegramMethod) -> PreparedSend:
+        """Serialize ``method`` once; its ``chat_id`` is replaced on every send."""
+        rest = self._encode(method, skip="chat_id")
+        return PreparedSend(method, self._url(method), b"&" + rest if rest else b"")
+
+    async def send(self, prepared: PreparedSend, chat_id: int) -> Union[SentMessage, List[SentMessage], Any]:
+        result = await self._post(prepared.method, prepared.url, prepared.body(chat_id))
+        return self._result(result, chat_id)
+
+    async def request(self, method: TelegramMethod, timeout: Optional[float] = None) -> Any:
+        """Call ``method`` and return its raw ``result`` (plain JSON, no aiogram models)."""
+        return await self._post(method, self._url(method), self._encode(method), timeout)
+
+    async def _post(self, method: TelegramMethod, url: str, body: bytes, timeout: Optional[float] = None) -> Any:
+        kwargs = {} if timeout is None else {"timeout": aiohttp.ClientTimeout(total=timeout)}
+        try:
+            async with self._get_session().post(url, data=body, headers={"Content-Type": self.CONTENT_TYPE},
+                                                **kwargs) as resp:
+                status = resp.status
+                raw = await resp.read()
+        except asyncio.TimeoutError:
+            raise TelegramNetworkError(method=method, message="Request timeout error")
+        except aiohttp.ClientError as e:
+            raise TelegramNetworkError(method=method, message=f"{type(e).__name__}: {e}")
+
+        if status == 200:
+            try:
+                data = json_loads(raw)
+            except ValueError:
+                data = None
+            if isinstance(data, dict) and data.get("ok"):
+                return data.get("result")
+        # errors (and anything unexpected): exactly aiogram's classification
+        self.bot.session.check_response(bot=self.bot, method=method, status_code=status,
+                                        content=raw.decode("utf-8", "replace"))
+        raise TelegramAPIError(method=method, message=f"Unexpected response (HTTP {status})")
+
+    @staticmethod
+    def _result(result: Any, chat_id: int):
+        if isinstance(result, dict) and "message_id" in result:
+            return SentMessage(result["message_id"], chat_id)
+        if isinstance(result, list):
+            return [SentMessage(m["message_id"], chat_id) for m in result if isinstance(m, dict)]
+        return result
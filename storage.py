@@ -0,0 +1,607 @@
+# storage.py
+"""
+Persistence backends for user documents.
+
+A user document is a plain dict: ``anon_id``, ``banned``, ``inactive``
+(bot blocked / chat gone), ``created_at``, ``last_send``, ``last_message``. Every backend implements the same async
+interface; blocking work (Firestore RPCs, file and SQLite I/O) runs in an
+executor so the event loop never waits on disk or network.
+
+Backends:
+  * ``FirestoreStorage`` - collection ``anon_bot_users`` (one doc per user)
+  * ``AsyncFirestoreStorage`` - the same collection through ``firestore.AsyncClient``
+    (no executor; concurrent reads are merged into ``get_all`` batches)
+  * ``SqliteStorage``    - embedded SQLite in WAL mode, one row per user
+  * ``JsonStorage``      - legacy ``users.json`` + ``banned_users.txt``
+
+Migrate legacy files once with::
+
+    python storage.py migrate [users.json] [banned_users.txt] [users.db]
+"""
+import asyncio
+import concurrent.futures
+import contextlib
+import functools
+import itertools
+import json
+import os
+import sqlite3
+import sys
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+import tracing
+
+UserDoc = Dict[str, Any]
+
+
+class Storage:
+    name = "base"
+
+    def __init__(self, executor: Optional[concurrent.futures.Executor] = None):
+        self._executor = executor
+        self.in_flight = 0  # backend calls currently running or waiting for a thread
+
+    async def _run(self, fn, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        trace = tracing.current()
+        call = functools.partial(fn, *args, **kwargs)
+        if trace is not None:
+            # split the time into waiting for a thread and the blocking call itself
+            submitted = time.perf_counter()
+            started = []
+
+            def call(inner=call):
+                started.append(time.perf_counter())
+                return inner()
+        self.in_flight += 1
+        try:
+            return await loop.run_in_executor(self._executor, call)
+        finally:
+            self.in_flight -= 1
+            if trace is not None and started:
+                trace.add("executor.wait", started[0] - submitted)
+                trace.add("executor.call", time.perf_counter() - started[0])
+
+    # ----- single user -----
+    async def get_user(self, uid: int) -> Optional[UserDoc]:
+        raise NotImplementedError
+
+    async def put_user(self, uid: int, data: UserDoc):
+        raise NotImplementedError
+
+    async def update_user(self, uid: int, updates: UserDoc) -> bool:
+        """Merge ``updates`` into an existing doc; False if the user does not exist."""
+        raise NotImplementedError
+
+    async def set_banned(self, uid: int, banned: bool) -> bool:
+        return await self.update_user(uid, {"banned": banned})
+
+    async def get_users(self, uids: Iterable[int]) -> Dict[int, Optional[UserDoc]]:
+        uids = list(uids)
+        docs = await asyncio.gather(*(self.get_user(uid) for uid in uids))
+        return dict(zip(uids, docs))
+
+    # ----- collections -----
+    async def list_users(self) -> List[Tuple[int, UserDoc]]:
+        raise NotImplementedError
+
+    async def list_recipients(self) -> List[int]:
+        return [uid for uid, doc in await self.list_users()
+                if not doc.get("banned", False) and not doc.get("inactive", False)]
+
+    async def find_by_anon(self, anon_id: str) -> Optional[int]:
+        """uid currently holding ``anon_id`` (full scan unless the backend can query)."""
+        for uid, doc in await self.list_users():
+            if doc.get("anon_id") == anon_id:
+                return uid
+        return None
+
+    async def bulk_update(self, updates: Dict[int, UserDoc]):
+        """Upsert-merge many docs at once (missing users are created)."""
+        for uid, upd in updates.items():
+            if not await self.update_user(uid, upd):
+                await self.put_user(uid, upd)
+
+    async def close(self):
+        pass
+
+
+# ---------------------------------------------------------------- Firestore
+class FirestoreStorage(Storage):
+    name = "firestore"
+    BATCH_LIMIT = 500  # Firestore limit for writes per batch commit
+
+    def __init__(self, collection, executor: Optional[concurrent.futures.Executor] = None):
+        super().__init__(executor)
+        self.collection = collection
+
+    def _get_sync(self, uid: int):
+        doc = self.collection.document(str(uid)).get()
+        return doc.to_dict() if doc.exists else None
+
+    async def get_user(self, uid: int) -> Optional[UserDoc]:
+        return await self._run(self._get_sync, uid)
+
+    async def put_user(self, uid: int, data: UserDoc):
+        await self._run(self.collection.document(str(uid)).set, data)
+
+    def _update_sync(self, uid: int, updates: UserDoc) -> bool:
+        try:
+            self.collection.document(str(uid)).update(updates)
+            return True
+        except Exception as e:
+            if type(e).__name__ == "NotFound":
+                return False
+            raise
+
+    async def update_user(self, uid: int, updates: UserDoc) -> bool:
+        return await self._run(self._update_sync, uid, updates)
+
+    def _list_sync(self):
+        out = []
+        for d in self.collection.stream():
+            try:
+                out.append((int(d.id), d.to_dict() or {}))
+            except ValueError:
+                pass
+        return out
+
+    async def list_users(self) -> List[Tuple[int, UserDoc]]:
+        return await self._run(self._list_sync)
+
+    def _find_by_anon_sync(self, anon_id: str) -> Optional[int]:
+        # single-field equality: served by Firestore's automatic index
+        for d in self.collection.where("anon_id", "==", anon_id).limit(1).stream():
+            try:
+                return int(d.id)
+            except ValueError:
+                pass
+        return None
+
+    async def find_by_anon(self, anon_id: str) -> Optional[int]:
+        return await self._run(self._find_by_anon_sync, anon_id)
+
+    def _bulk_update_sync(self, items: List[Tuple[int, UserDoc]]):
+        client = self.collection._client
+        for i in range(0, len(items), self.BATCH_LIMIT):
+            batch = client.batch()
+            for uid, upd in items[i:i + self.BATCH_LIMIT]:
+                batch.set(self.collection.document(str(uid)), upd, merge=True)
+            batch.commit()
+
+    async def bulk_update(self, updates: Dict[int, UserDoc]):
+        await self._run(self._bulk_update_sync, list(updates.items()))
+
+
+class AsyncFirestoreStorage(Storage):
+    """
+    Firestore through the native asyncio client: no executor threads, storage
+    latency is the Firestore round trip. ``collections`` is the same collection
+    opened on several ``AsyncClient``s (one gRPC channel each), used
+    round-robin. At most ``max_concurrency`` RPCs run at once; ``get_user``
+    calls arriving within ``batch_window`` seconds are merged into one
+    ``get_all`` of up to ``batch_max`` documents.
+    """
+    name = "firestore-async"
+    BATCH_LIMIT = 500
+
+    def __init__(self, collections: List[Any], max_concurrency: int = 64, batch_window: float = 0.002,
+                 batch_max: int = 100, on_batch: Optional[Callable[[int], None]] = None):
+        super().__init__()
+        self.collections = list(collections)
+        self._rr = itertools.cycle(self.collections)
+        self._sem = asyncio.Semaphore(max(1, max_concurrency))
+        self.batch_window = batch_window
+        self.batch_max = max(1, batch_max)
+        self._pending: Dict[int, List[asyncio.Future]] = {}
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        self._batch_tasks: set = set()
+        self.on_batch = on_batch  # called with the size of every get_all
+
+    @property
+    def collection(self):
+        return self.collections[0]
+
+    @contextlib.asynccontextmanager
+    async def _rpc(self):
+        self.in_flight += 1
+        try:
+            with tracing.span("firestore.wait"):
+                await self._sem.acquire()
+            try:
+                with tracing.span("firestore.rpc"):
+                    yield next(self._rr)
+            finally:
+                self._sem.release()
+        finally:
+            self.in_flight -= 1
+
+    # ----- reads: micro-batched -----
+    async def get_user(self, uid: int) -> Optional[UserDoc]:
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        self._pending.setdefault(uid, []).append(fut)
+        if len(self._pending) >= self.batch_max:
+            self._flush_reads()
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.batch_window, self._flush_reads)
+        return await fut
+
+    def _flush_reads(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        pending, self._pending = self._pending, {}
+        if pending:
+            task = asyncio.ensure_future(self._get_batch(pending))
+            self._batch_tasks.add(task)
+            task.add_done_callback(self._batch_tasks.discard)
+
+    async def _get_batch(self, pending: Dict[int, List[asyncio.Future]]):
+        found: Dict[int, UserDoc] = {}
+        try:
+            async with self._rpc() as col:
+                refs = [col.document(str(uid)) for uid in pending]
+                async for snap in col._client.get_all(refs):
+                    if snap.exists:
+                        found[int(snap.id)] = snap.to_dict()
+        except Exception as e:
+            for futs in pending.values():
+                for fut in futs:
+                    if not fut.done():
+                        fut.set_exception(e)
+            return
+        if self.on_batch is not None:
+            self.on_batch(len(pending))
+        for uid, futs in pending.items():
+            doc = found.get(uid)
+            for fut in futs:
+                if not fut.done():
+                    fut.set_result(doc)
+
+    # ----- writes -----
+    async def put_user(self, uid: int, data: UserDoc):
+        async with self._rpc() as col:
+            await col.document(str(uid)).set(data)
+
+    async def update_user(self, uid: int, updates: UserDoc) -> bool:
+        try:
+            async with self._rpc() as col:
+                await col.document(str(uid)).update(updates)
+            return True
+        except Exception as e:
+            if type(e).__name__ == "NotFound":
+                return False
+            raise
+
+    async def list_users(self) -> List[Tuple[int, UserDoc]]:
+        out = []
+        async with self._rpc() as col:
+            async for d in col.stream():
+                try:
+                    out.append((int(d.id), d.to_dict() or {}))
+                except ValueError:
+                    pass
+        return out
+
+    async def find_by_anon(self, anon_id: str) -> Optional[int]:
+        async with self._rpc() as col:
+            async for d in col.where("anon_id", "==", anon_id).limit(1).stream():
+                try:
+                    return int(d.id)
+                except ValueError:
+                    pass
+        return None
+
+    async def _commit_chunk(self, items: List[Tuple[int, UserDoc]]):
+        async with self._rpc() as col:
+            batch = col._client.batch()
+            for uid, upd in items:
+                batch.set(col.document(str(uid)), upd, merge=True)
+            await batch.commit()
+
+    async def bulk_update(self, updates: Dict[int, UserDoc]):
+        items = list(updates.items())
+        # chunks commit in parallel, bounded by the RPC semaphore
+        await asyncio.gather(*(self._commit_chunk(items[i:i + self.BATCH_LIMIT])
+                               for i in range(0, len(items), self.BATCH_LIMIT)))
+
+    async def close(self):
+        if self._pending:
+            self._flush_reads()
+        await asyncio.gather(*self._batch_tasks, return_exceptions=True)
+        for col in self.collections:
+            close = getattr(col._client, "close", None)
+            if close is not None:
+                res = close()
+                if asyncio.iscoroutine(res):
+                    await res
+
+
+# ---------------------------------------------------------------- SQLite
+class SqliteStorage(Storage):
+    """
+    One row per user. Writes touch a single row, the file is opened in WAL
+    mode so readers never block the writer. All access goes through a
+    dedicated single thread, which also serializes read-modify-write updates.
+    """
+    name = "sqlite"
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS users (
+            uid      INTEGER PRIMARY KEY,
+            anon_id  TEXT,
+            banned   INTEGER NOT NULL DEFAULT 0,
+            inactive INTEGER NOT NULL DEFAULT 0,
+            data     TEXT NOT NULL DEFAULT '{}'
+        );
+        CREATE INDEX IF NOT EXISTS users_anon_id ON users (anon_id);
+    """
+    COLUMNS = "anon_id, banned, inactive, data"
+    FLAGS = ("banned", "inactive")
+
+    def __init__(self, path: str):
+        super().__init__(concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite"))
+        self.path = path
+        self._conn: Optional[sqlite3.Connection] = None
+
+    def conn(self) -> sqlite3.Connection:
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(self.SCHEMA)
+            columns = {r[1] for r in conn.execute("PRAGMA table_info(users)")}
+            if "inactive" not in columns:  # databases created before the inactive flag
+                conn.execute("ALTER TABLE users ADD COLUMN inactive INTEGER NOT NULL DEFAULT 0")
+            self._conn = conn
+        return self._conn
+
+    @staticmethod
+    def _row_to_doc(row) -> UserDoc:
+        doc = json.loads(row[3]) if row[3] else {}
+        doc["anon_id"] = row[0]
+        doc["banned"] = bool(row[1])
+        doc["inactive"] = bool(row[2])
+        return doc
+
+    def _doc_to_row(self, uid: int, doc: UserDoc) -> tuple:
+        extra = {k: v for k, v in doc.items() if k != "anon_id" and k not in self.FLAGS}
+        return (uid, doc.get("anon_id"), int(bool(doc.get("banned", False))),
+                int(bool(doc.get("inactive", False))), json.dumps(extra, ensure_ascii=False))
+
+    def _upsert_rows(self, conn: sqlite3.Connection, rows: List[tuple]):
+        conn.executemany(f"INSERT OR REPLACE INTO users (uid, {self.COLUMNS}) VALUES (?, ?, ?, ?, ?)", rows)
+
+    def _get_sync(self, uid: int):
+        row = self.conn().execute(f"SELECT {self.COLUMNS} FROM users WHERE uid = ?", (uid,)).fetchone()
+        return self._row_to_doc(row) if row else None
+
+    async def get_user(self, uid: int) -> Optional[UserDoc]:
+        return await self._run(self._get_sync, uid)
+
+    def _put_many_sync(self, items: Iterable[Tuple[int, UserDoc]]):
+        rows = [self._doc_to_row(uid, data) for uid, data in items]
+        conn = self.conn()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")  # take the write lock up front: other workers share the file
+            self._upsert_rows(conn, rows)
+
+    async def put_user(self, uid: int, data: UserDoc):
+        await self._run(self._put_many_sync, [(uid, data)])
+
+    def _update_many_sync(self, updates: Dict[int, UserDoc], upsert: bool) -> bool:
+        conn = self.conn()
+        found_all = True
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")  # take the write lock up front: other workers share the file
+            rows = []
+            for uid, upd in updates.items():
+                row = conn.execute(f"SELECT {self.COLUMNS} FROM users WHERE uid = ?", (uid,)).fetchone()
+                if row is None and not upsert:
+                    found_all = False
+                    continue
+                doc = self._row_to_doc(row) if row else {}
+                doc.update(upd)
+                rows.append(self._doc_to_row(uid, doc))
+            self._upsert_rows(conn, rows)
+        return found_all
+
+    async def update_user(self, uid: int, updates: UserDoc) -> bool:
+        return await self._run(self._update_many_sync, {uid: updates}, False)
+
+    def _set_banned_sync(self, uid: int, banned: bool) -> bool:
+        cur = self.conn().execute("UPDATE users SET banned = ? WHERE uid = ?", (int(banned), uid))
+        return cur.rowcount > 0
+
+    async def set_banned(self, uid: int, banned: bool) -> bool:
+        return await self._run(self._set_banned_sync, uid, banned)
+
+    def _list_sync(self):
+        rows = self.conn().execute(f"SELECT uid, {self.COLUMNS} FROM users").fetchall()
+        return [(r[0], self._row_to_doc(r[1:])) for r in rows]
+
+    async def list_users(self) -> List[Tuple[int, UserDoc]]:
+        return await self._run(self._list_sync)
+
+    def _recipients_sync(self):
+        return [r[0] for r in self.conn().execute("SELECT uid FROM users WHERE banned = 0 AND inactive = 0")]
+
+    async def list_recipients(self) -> List[int]:
+        return await self._run(self._recipients_sync)
+
+    def _find_by_anon_sync(self, anon_id: str) -> Optional[int]:
+        row = self.conn().execute("SELECT uid FROM users WHERE anon_id = ? LIMIT 1", (anon_id,)).fetchone()
+        return row[0] if row else None
+
+    async def find_by_anon(self, anon_id: str) -> Optional[int]:
+        return await self._run(self._find_by_anon_sync, anon_id)
+
+    async def bulk_update(self, updates: Dict[int, UserDoc]):
+        await self._run(self._update_many_sync, updates, True)
+
+    def is_empty(self) -> bool:
+        return self.conn().execute("SELECT 1 FROM users LIMIT 1").fetchone() is None
+
+    def import_docs(self, docs: Iterable[Tuple[int, UserDoc]]):
+        """Synchronous bulk insert (migration / tooling)."""
+        self._put_many_sync(docs)
+
+    async def close(self):
+        def _close():
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+        await self._run(_close)
+
+
+# ---------------------------------------------------------------- legacy JSON
+def load_users_file(path: str) -> Dict[int, str]:
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        return {int(k): v for k, v in data.items()}
+    except Exception as e:
+        print(f"Failed to load {path}:", e)
+        return {}
+
+
+def load_banned_file(path: str) -> set:
+    if not os.path.exists(path):
+        return set()
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return set(int(line.strip()) for line in f if line.strip().isdigit())
+    except Exception as e:
+        print("Failed to load banned file:", e)
+        return set()
+
+
+class JsonStorage(Storage):
+    """
+    Legacy format: ``{uid: anon_id}`` in users.json and one banned uid per line.
+    Every new user rewrites the whole file; prefer ``SqliteStorage``. The
+    format has no place for the ``inactive`` flag, it is kept in memory only.
+    Files are written from snapshots on a dedicated single thread, in order.
+    """
+    name = "json"
+
+    def __init__(self, users_file: str, banned_file: str):
+        super().__init__(concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="json"))
+        self.users_file = users_file
+        self.banned_file = banned_file
+        self.users = load_users_file(users_file)
+        self.banned = load_banned_file(banned_file)
+        self.inactive: set = set()
+
+    def _doc(self, uid: int) -> Optional[UserDoc]:
+        if uid not in self.users and uid not in self.banned:
+            return None
+        return {"anon_id": self.users.get(uid), "banned": uid in self.banned, "inactive": uid in self.inactive,
+                "last_send": 0.0, "last_message": ""}
+
+    async def get_user(self, uid: int) -> Optional[UserDoc]:
+        return self._doc(uid)
+
+    def _save_users_sync(self, users: Dict[str, Optional[str]]):
+        tmp = self.users_file + ".tmp"
+        try:
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(users, f, ensure_ascii=False, indent=2)
+            os.replace(tmp, self.users_file)
+        except Exception as e:
+            print("Failed to save users.json:", e)
+
+    def _append_banned_sync(self, uid: int):
+        try:
+            with open(self.banned_file, "a", encoding="utf-8") as f:
+                f.write(f"{uid}\n")
+        except Exception as e:
+            print("Failed to append banned:", e)
+
+    def _rewrite_banned_sync(self, banned: List[int]):
+        try:
+            with open(self.banned_file, "w", encoding="utf-8") as f:
+                for uid in banned:
+                    f.write(f"{uid}\n")
+        except Exception as e:
+            print("Failed to write banned file:", e)
+
+    async def _save_users(self):
+        # the snapshot is taken here, on the loop: the thread never sees a dict being changed
+        await self._run(self._save_users_sync, {str(k): v for k, v in self.users.items()})
+
+    async def _rewrite_banned(self):
+        await self._run(self._rewrite_banned_sync, sorted(self.banned))
+
+    async def _apply(self, uid: int, data: UserDoc):
+        if "inactive" in data:
+            (self.inactive.add if data["inactive"] else self.inactive.discard)(uid)
+        users_changed = "anon_id" in data and self.users.get(uid) != data["anon_id"]
+        if users_changed:
+            self.users[uid] = data["anon_id"]
+            await self._save_users()
+        if "banned" in data:
+            if data["banned"] and uid not in self.banned:
+                self.banned.add(uid)
+                await self._run(self._append_banned_sync, uid)
+            elif not data["banned"] and uid in self.banned:
+                self.banned.discard(uid)
+                await self._rewrite_banned()
+
+    async def put_user(self, uid: int, data: UserDoc):
+        await self._apply(uid, data)
+
+    async def update_user(self, uid: int, updates: UserDoc) -> bool:
+        if uid not in self.users and uid not in self.banned:
+            return False
+        await self._apply(uid, updates)
+        return True
+
+    async def list_users(self) -> List[Tuple[int, UserDoc]]:
+        return [(uid, self._doc(uid)) for uid in self.users.keys() | self.banned]
+
+    async def list_recipients(self) -> List[int]:
+        return [uid for uid in self.users if uid not in self.banned and uid not in self.inactive]
+
+    async def bulk_update(self, updates: Dict[int, UserDoc]):
+        if all(upd.keys() <= {"inactive"} for upd in updates.values()):
+            for uid, upd in updates.items():
+                (self.inactive.add if upd["inactive"] else self.inactive.discard)(uid)
+            return
+        for uid, upd in updates.items():
+            if "inactive" in upd:
+                (self.inactive.add if upd["inactive"] else self.inactive.discard)(uid)
+            if "anon_id" in upd:
+                self.users[uid] = upd["anon_id"]
+            if "banned" in upd:
+                (self.banned.add if upd["banned"] else self.banned.discard)(uid)
+        await self._save_users()
+        await self._rewrite_banned()
+
+
+# ---------------------------------------------------------------- migration
+def migrate_legacy(users_file: str, banned_file: str, sqlite_path: str) -> int:
+    """Copy users.json + banned_users.txt into a SQLite database; returns rows written."""
+    users = load_users_file(users_file)
+    banned = load_banned_file(banned_file)
+    store = SqliteStorage(sqlite_path)
+    docs = []
+    for uid in users.keys() | banned:
+        docs.append((uid, {"anon_id": users.get(uid), "banned": uid in banned, "created_at": 0.0,
+                           "last_send": 0.0, "last_message": ""}))
+    store.import_docs(docs)
+    store.conn().close()
+    return len(docs)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] != "migrate":
+        print(__doc__)
+        sys.exit(1)
+    args = sys.argv[2:] + ["users.json", "banned_users.txt", "users.db"][len(sys.argv) - 2:]
+    n = migrate_legacy(*args[:3])
+    print(f"Migrated {n} users from {args[0]} / {args[1]} into {args[2]}")
@@ -0,0 +1,137 @@
+# tracing.py
+"""
+Lightweight per-update tracing and an on-demand profiler.
+
+A ``Trace`` follows one update from the webhook to the end of its broadcast:
+``span(name)`` blocks add their duration to the trace of the current context
+(a ContextVar, so tasks spawned while handling the update report into it as
+well). Spans with the same name are aggregated (count / total / max), so a
+broadcast with 10k sends costs three numbers, not 10k records. Outside a
+trace ``span`` only reads the ContextVar.
+
+``profile(seconds)`` runs cProfile over the event loop thread for a while and
+returns the hottest functions as text.
+"""
+import asyncio
+import contextvars
+import cProfile
+import io
+import pstats
+import time
+from typing import Dict, List, Optional
+
+_current: contextvars.ContextVar = contextvars.ContextVar("trace", default=None)
+
+
+class Trace:
+    __slots__ = ("update_id", "started", "mark", "spans")
+
+    def __init__(self, update_id, started: Optional[float] = None):
+        self.update_id = update_id
+        self.started = time.perf_counter() if started is None else started
+        self.mark = self.started
+        self.spans: Dict[str, List[float]] = {}  # name -> [count, total, max]
+
+    def lap(self, name: str):
+        """Record the time since the previous lap (or the start) as ``name``."""
+        now = time.perf_counter()
+        self.add(name, now - self.mark)
+        self.mark = now
+
+    def add(self, name: str, seconds: float):
+        s = self.spans.get(name)
+        if s is None:
+            self.spans[name] = [1, seconds, seconds]
+        else:
+            s[0] += 1
+            s[1] += seconds
+            if seconds > s[2]:
+                s[2] = seconds
+
+    @property
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.started
+
+    def breakdown(self) -> str:
+        parts = []
+        for name, (count, total, peak) in sorted(self.spans.items(), key=lambda kv: -kv[1][1]):
+            if count == 1:
+                parts.append(f"{name} {total * 1000:.1f}ms")
+            else:
+                parts.append(f"{name} {count}x {total * 1000:.1f}ms (max {peak * 1000:.1f}ms)")
+        return ", ".join(parts)
+
+
+class span:
+    """``with span("is_banned"):`` — time the block into the current trace, if any."""
+    __slots__ = ("name", "trace", "t0")
+
+    def __init__(self, name: str, trace: Optional[Trace] = None):
+        self.name = name
+        self.trace = trace
+
+    def __enter__(self):
+        if self.trace is None:
+            self.trace = _current.get()
+        if self.trace is not None:
+            self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        if self.trace is not None:
+            self.trace.add(self.name, time.perf_counter() - self.t0)
+        return False
+
+
+def current() -> Optional[Trace]:
+    return _current.get()
+
+
+def activate(trace: Optional[Trace]):
+    """Make ``trace`` current in this context; returns the token for ``deactivate``."""
+    return _current.set(trace)
+
+
+def deactivate(token):
+    _current.reset(token)
+
+
+# ---------------------------------------------------------------- profiler
+_profiling = False
+
+
+def is_profiling() -> bool:
+    return _profiling
+
+
+async def profile(seconds: float, top: int = 20, sort: str = "tottime") -> str:
+    """Profile everything on this thread for ``seconds``; top functions as text."""
+    global _profiling
+    if _profiling:
+        raise RuntimeError("a profile is already running")
+    _profiling = True
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+        await asyncio.sleep(seconds)
+    finally:
+        profiler.disable()
+        _profiling = False
+    out = io.StringIO()
+    stats = pstats.Stats(profiler, stream=out)
+    stats.sort_stats(sort).print_stats(top)
+    return out.getvalue()
+
+
+def top_functions(report: str, width: int = 100) -> str:
+    """The table part of a pstats report with long paths trimmed (fits a Telegram message)."""
+    lines = report.splitlines()
+    start = next((i for i, line in enumerate(lines) if line.lstrip().startswith("ncalls")), 0)
+    table = []
+    for line in lines[start:]:
+        if not line.strip():
+            continue
+        if len(line) > width:
+            line = line[:45] + "…" + line[-(width - 46):]
+        table.append(line)
+    return "\n".join(table)